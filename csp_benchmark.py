@@ -0,0 +1,350 @@
+'''Reproducible benchmarks for the propagators and CSP models.
+
+Every (workload, propagator) pair is run in its own process (so one
+case cannot warm caches or leak memory into the next, and a case that
+runs past --timeout is simply killed). For each run we record
+
+    build_wall       seconds spent building the CSP model
+    wall, cpu        seconds spent in bt_search
+    nDecisions, nPrunings, solved
+    peak_rss_kb      peak resident memory of the process (Unix only)
+
+and write everything as JSON. With --compare BASELINE.json the results
+are checked against a saved run and regressions are listed (exit status
+1 if there are any).
+
+    python csp_benchmark.py --out bench.json
+    python csp_benchmark.py --quick --compare bench.json
+'''
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from cspbase import *
+import propagators
+import futoshiki_csp
+
+try:
+    import resource
+except ImportError:         #not on Windows
+    resource = None
+
+########################################################
+# Workloads                                            #
+########################################################
+
+def queensPredicate(qi, qj, vals):
+    '''Queens in rows qi and qj are not in the same column or diagonal'''
+    i, j = vals
+    return i != j and abs(i-j) != abs(qi-qj)
+
+def build_queens(n):
+    '''Return an n-queens CSP (one variable per row)'''
+    dom = list(range(1, n+1))
+    vars = [Variable('Q{}'.format(i), dom) for i in dom]
+    csp = CSP("{}-Queens".format(n), vars)
+    for qi in range(n):
+        for qj in range(qi+1, n):
+            csp.add_constraint(PredicateConstraint(
+                "C(Q{},Q{})".format(qi+1,qj+1), [vars[qi], vars[qj]],
+                functools.partial(queensPredicate, qi, qj)))
+    return csp
+
+def w_eq_sum_x_y_z(wxyz):
+    return wxyz[0] == wxyz[1] + wxyz[2] + wxyz[3]
+
+def build_simple_eqs():
+    '''The SimpleEqs CSP of csp_sample_run.py'''
+    x = Variable('X', [1, 2, 3])
+    y = Variable('Y', [1, 2, 3])
+    z = Variable('Z', [1, 2, 3])
+    w = Variable('W', [1, 2, 3, 4])
+    c1 = Constraint('C1', [x, y, z])
+    c1.add_satisfying_tuples([[2, 1, 1], [3, 1, 2], [3, 2, 1]])
+    c2 = PredicateConstraint('C2', [w, x, y, z], w_eq_sum_x_y_z)
+    csp = CSP("SimpleEqs", [x, y, z, w])
+    csp.add_constraint(c1)
+    csp.add_constraint(c2)
+    return csp
+
+PUZZLE1 = [[3,'.',0,'.',0,'<',0],[0,'.',0,'.',0,'.',0],
+           [0,'.',0,'<',0,'.',0],[0,'.',0,'>',0,'.',1]]
+
+def random_futoshiki_board(n, seed, n_givens=None, n_ineqs=None):
+    '''Return a solvable n x n board in the initial_futoshiki_board
+       format, generated from seed: a shuffled latin square of which
+       n_givens cells (default n) and n_ineqs row inequalities (default
+       n) are revealed.'''
+    rng = random.Random(seed)
+    rows = list(range(n))
+    cols = list(range(n))
+    syms = list(range(1, n+1))
+    rng.shuffle(rows)
+    rng.shuffle(cols)
+    rng.shuffle(syms)
+    soln = [[syms[(rows[r] + cols[c]) % n] for c in range(n)] for r in range(n)]
+
+    board = [[0 if k % 2 == 0 else '.' for k in range(2*n - 1)] for r in range(n)]
+    cells = [(r, c) for r in range(n) for c in range(n)]
+    for r, c in rng.sample(cells, n if n_givens is None else n_givens):
+        board[r][2*c] = soln[r][c]
+    gaps = [(r, c) for r in range(n) for c in range(n-1)]
+    for r, c in rng.sample(gaps, n if n_ineqs is None else n_ineqs):
+        board[r][2*c + 1] = '<' if soln[r][c] < soln[r][c+1] else '>'
+    return board
+
+def build_futoshiki(model, n, seed=None):
+    '''futoshiki_csp_model_<model> on PUZZLE1 (n == 4 and seed None)
+       or on random_futoshiki_board(n, seed)'''
+    if seed is None:
+        board = PUZZLE1
+    else:
+        board = random_futoshiki_board(n, seed)
+    build = getattr(futoshiki_csp, 'futoshiki_csp_model_{}'.format(model))
+    return build(board)[0]
+
+def workloads(quick=False):
+    '''Return list of (name, builder, args)'''
+    cases = [('SimpleEqs', 'build_simple_eqs', ())]
+    for n in ((8, 16) if quick else (8, 16, 32, 64)):
+        cases.append(('queens-{}'.format(n), 'build_queens', (n,)))
+    for model in (1, 2, 3):
+        cases.append(('futoshiki-m{}-4'.format(model), 'build_futoshiki',
+                      (model, 4)))
+        sizes = (5, 6) if quick else (5, 6, 7, 8)
+        if model == 3 and not quick:
+            sizes = sizes + (12,)
+        for n in sizes:
+            cases.append(('futoshiki-m{}-{}-s{}'.format(model, n, n),
+                          'build_futoshiki', (model, n, n)))
+    return cases
+
+########################################################
+# Running                                              #
+########################################################
+
+def peak_rss_kb():
+    '''Peak resident set size of this process in KB (None if unknown)'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024   #bytes on macOS
+    return rss
+
+def run_case(builder, args, prop_name):
+    '''Build and solve one workload in this process, return a dict of
+       measurements'''
+    build = globals()[builder]
+    w0 = time.perf_counter()
+    csp = build(*args)
+    build_wall = time.perf_counter() - w0
+
+    solver = BT(csp)
+    w0 = time.perf_counter()
+    c0 = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        solved = solver.bt_search(propagators.PROPAGATORS[prop_name])
+    wall = time.perf_counter() - w0
+    cpu = time.process_time() - c0
+    return {'build_wall': build_wall, 'wall': wall, 'cpu': cpu,
+            'nDecisions': solver.nDecisions, 'nPrunings': solver.nPrunings,
+            'solved': bool(solved), 'peak_rss_kb': peak_rss_kb()}
+
+def _child(conn, builder, args, prop_name):
+    try:
+        conn.send(run_case(builder, args, prop_name))
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    conn.close()
+
+def run_isolated(builder, args, prop_name, timeout):
+    '''run_case in a fresh process, killed after timeout seconds'''
+    ctx = multiprocessing.get_context()
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(send, builder, args, prop_name))
+    proc.start()
+    send.close()
+    if recv.poll(timeout):
+        result = recv.recv()
+    else:
+        result = {'timeout': timeout}
+    proc.terminate()
+    proc.join()
+    return result
+
+def run_suite(cases, prop_names, timeout, repeat=1, log=None):
+    '''Run every case with every propagator, return list of result dicts.
+       With repeat > 1 the fastest of the repeats is kept.'''
+    results = []
+    for name, builder, args in cases:
+        for prop_name in prop_names:
+            best = None
+            for r in range(repeat):
+                res = run_isolated(builder, args, prop_name, timeout)
+                if 'wall' not in res:
+                    best = res
+                    break
+                if best is None or res['wall'] < best['wall']:
+                    best = res
+            best = dict(best, workload=name, propagator=prop_name)
+            results.append(best)
+            if log is not None:
+                log(format_result(best))
+    return results
+
+def format_result(res):
+    head = '{:<24} {:<4}'.format(res['workload'], res['propagator'])
+    if 'timeout' in res:
+        return head + ' TIMEOUT after {}s'.format(res['timeout'])
+    if 'error' in res:
+        return head + ' ERROR ' + res['error']
+    return head + (' build {:8.3f}s  wall {:8.3f}s  cpu {:8.3f}s  '
+                   'decisions {:7d}  prunings {:8d}  rss {} KB').format(
+        res['build_wall'], res['wall'], res['cpu'], res['nDecisions'],
+        res['nPrunings'], res['peak_rss_kb'])
+
+def model_memory(model, n, share=True, seed=0):
+    '''Memory (tracemalloc) of building futoshiki model <model> on
+       random_futoshiki_board(n, seed), with or without shared
+       relations (futoshiki_csp.SHARE_RELATIONS). Returns a dict with
+       current_bytes (held by the built CSP), peak_bytes and build_wall'''
+    old = futoshiki_csp.SHARE_RELATIONS
+    futoshiki_csp.SHARE_RELATIONS = share
+    tracemalloc.start()
+    try:
+        w0 = time.perf_counter()
+        csp = build_futoshiki(model, n, seed)
+        build_wall = time.perf_counter() - w0
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        futoshiki_csp.SHARE_RELATIONS = old
+    return {'workload': 'futoshiki-m{}-{}'.format(model, n), 'share': share,
+            'current_bytes': current, 'peak_bytes': peak,
+            'build_wall': build_wall}
+
+def memory_report(n=9, models=(1, 2), log=None):
+    '''model_memory without and with shared relations for each model'''
+    results = []
+    for model in models:
+        for share in (False, True):
+            res = model_memory(model, n, share)
+            results.append(res)
+            if log is not None:
+                log('{:<24} {:<9} held {:9.1f} MB  peak {:9.1f} MB  '
+                    'build {:7.2f}s'.format(
+                        res['workload'], 'shared' if share else 'copied',
+                        res['current_bytes'] / 2**20,
+                        res['peak_bytes'] / 2**20, res['build_wall']))
+    return results
+
+########################################################
+# Baseline comparison                                  #
+########################################################
+
+def compare(results, baseline, tolerance=0.10, min_seconds=0.05):
+    '''Compare results against the results of a saved run. Returns a
+       list of (workload, propagator, problem) for runs that got worse:
+       slower wall or build time (by more than tolerance and
+       min_seconds), more memory (by more than tolerance), more
+       decisions, or no longer finishing/solving.'''
+    base = dict()
+    for res in baseline:
+        base[(res['workload'], res['propagator'])] = res
+    problems = []
+    for res in results:
+        key = (res['workload'], res['propagator'])
+        old = base.get(key)
+        if old is None or 'wall' not in old:
+            continue
+        if 'wall' not in res:
+            problems.append(key + ('no longer finishes ({})'.format(
+                'timeout' if 'timeout' in res else res.get('error')),))
+            continue
+        if old['solved'] and not res['solved']:
+            problems.append(key + ('no longer solved',))
+        for field in ('wall', 'build_wall'):
+            if (res[field] > old[field] * (1 + tolerance) and
+                    res[field] - old[field] > min_seconds):
+                problems.append(key + ('{} {:.3f}s -> {:.3f}s'.format(
+                    field, old[field], res[field]),))
+        if (old['peak_rss_kb'] and res['peak_rss_kb'] and
+                res['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance)):
+            problems.append(key + ('peak_rss_kb {} -> {}'.format(
+                old['peak_rss_kb'], res['peak_rss_kb']),))
+        if res['nDecisions'] > old['nDecisions']:
+            problems.append(key + ('nDecisions {} -> {}'.format(
+                old['nDecisions'], res['nDecisions']),))
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='small instances only')
+    parser.add_argument('--props', default='BT,FC,GAC',
+                        help='comma separated propagators ({})'.format(
+                            ','.join(propagators.PROPAGATORS)))
+    parser.add_argument('--filter', default='',
+                        help='only workloads whose name contains this')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds allowed per run')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='keep the fastest of this many runs')
+    parser.add_argument('--out', help='write JSON results to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed relative slowdown for --compare')
+    parser.add_argument('--memory', type=int, metavar='N', default=None,
+                        help='only report the memory of futoshiki models 1 '
+                        'and 2 at size N with and without shared relations')
+    opts = parser.parse_args(argv)
+
+    if opts.memory is not None:
+        results = memory_report(opts.memory,
+                                log=lambda line: print(line, file=sys.stderr))
+        print(json.dumps(results, indent=1))
+        return 0
+
+    cases = [c for c in workloads(opts.quick) if opts.filter in c[0]]
+    prop_names = opts.props.split(',')
+    for p in prop_names:
+        if p not in propagators.PROPAGATORS:
+            parser.error('unknown propagator {}'.format(p))
+
+    results = run_suite(cases, prop_names, opts.timeout, opts.repeat,
+                        log=lambda line: print(line, file=sys.stderr))
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    text = json.dumps(report, indent=1)
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+        problems = compare(results, baseline, opts.tolerance)
+        for workload, prop_name, problem in problems:
+            print('REGRESSION {} {}: {}'.format(workload, prop_name, problem),
+                  file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
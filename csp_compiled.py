@@ -0,0 +1,402 @@
+'''Compiled CSPs: integer arrays instead of objects
+
+   compile_csp(csp) freezes a CSP into a CompiledCSP. Variables,
+   values and constraints are numbered and everything the search needs
+   is kept in flat lists indexed by those numbers:
+
+       values[v]      domain of variable v (value k has bit 1 << k)
+       init[v]        domain bitmask of v when compiled
+       scope[c]       tuple of variable numbers of constraint c
+       var_cons[v]    numbers of the constraints on variable v
+       kind[c]        how c is propagated:
+                        BINARY   masks[c][pos][k] == bitmask of the
+                                 values of the other variable compatible
+                                 with value k of scope[c][pos]
+                        TABLE    tuples[c] == tuples of value numbers,
+                                 supports[c][pos][k] == numbers of the
+                                 tuples with value k at pos
+                        FILTER   cons[c].filter_masks(masks) gives the
+                                 supported values of each scope position
+                                 (Regin's algorithm for AllDiffConstraint,
+                                 bounds sweeps for InequalityConstraint)
+                        CHECK    constraint.check on the values of the
+                                 last unfixed variable (forward checking)
+
+   CompiledSolver runs a backtracking search on these arrays (a
+   domain is an int, an assignment a domain of one bit, undo a list of
+   (variable, old mask) pairs) and writes the solution back to the
+   Variable objects with assign, so models such as futoshiki_csp.py
+   work unchanged. Every constraint is made GAC except CHECK ones, which
+   are forward checked:
+
+       solver = CompiledSolver(compile_csp(csp))
+       if solver.solve():
+           csp.print_soln()
+
+   Compilation reads the current domains, so compile again after
+   changing the CSP. Other predicate constraints over more than two
+   variables are turned into tables if they have at most table_limit
+   candidate tuples, and are CHECK constraints otherwise.
+'''
+
+import itertools
+import time
+
+from cspbase import *
+from cspbase import _popcount
+
+BINARY, TABLE, FILTER, CHECK = range(4)
+
+class CompiledCSP:
+    '''Integer-indexed arrays of a CSP (see compile_csp)'''
+
+    def __init__(self, csp, table_limit=10000):
+        self.csp = csp
+        self.vars = list(csp.vars)
+        number = dict()
+        for v, var in enumerate(self.vars):
+            number[var] = v
+        self.values = [list(var.dom) for var in self.vars]
+        self.init = [var.cur_mask() for var in self.vars]
+
+        self.cons = list(csp.cons)
+        self.scope = []
+        self.kind = []
+        self.masks = []
+        self.tuples = []
+        self.supports = []
+        self.var_cons = [[] for var in self.vars]
+        for c, con in enumerate(self.cons):
+            scope = tuple(number[var] for var in con.scope)
+            self.scope.append(scope)
+            for v in set(scope):
+                self.var_cons[v].append(c)
+            masks = tuples = supports = None
+            if hasattr(con, 'filter_masks') and len(scope) > 2:
+                kind = FILTER
+            elif len(set(scope)) == 2 and len(scope) == 2:
+                kind = BINARY
+                masks = self._binary_masks(con)
+            elif con.sat_tuples or type(con) is Constraint:
+                kind = TABLE
+                tuples = self._table_tuples(con, con.sat_tuples)
+            elif self._ncandidates(con) <= table_limit:
+                kind = TABLE
+                tuples = self._table_tuples(con, (
+                    t for t in itertools.product(*[var.dom for var in con.scope])
+                    if con.check(t)))
+            else:
+                kind = CHECK
+            if tuples is not None:
+                supports = [[[] for val in var.dom] for var in con.scope]
+                for i, t in enumerate(tuples):
+                    for pos, k in enumerate(t):
+                        supports[pos][k].append(i)
+            self.kind.append(kind)
+            self.masks.append(masks)
+            self.tuples.append(tuples)
+            self.supports.append(supports)
+
+    def _binary_masks(self, con):
+        x, y = con.scope
+        sx = [0] * len(x.dom)
+        sy = [0] * len(y.dom)
+        if con.sat_tuples or type(con) is Constraint:
+            pairs = ((x.dom_index.get(a), y.dom_index.get(b))
+                     for a, b in con.sat_tuples)
+        else:
+            pairs = ((i, j) for i, a in enumerate(x.dom)
+                     for j, b in enumerate(y.dom) if con.check([a, b]))
+        for i, j in pairs:
+            if i is not None and j is not None:
+                sx[i] |= 1 << j
+                sy[j] |= 1 << i
+        return (sx, sy)
+
+    def _table_tuples(self, con, tuples):
+        '''value number tuples of the tuples within the domains'''
+        result = []
+        for t in tuples:
+            idx = []
+            for var, val in zip(con.scope, t):
+                k = var.dom_index.get(val)
+                if k is None:
+                    break
+                idx.append(k)
+            else:
+                result.append(tuple(idx))
+        return result
+
+    def _ncandidates(self, con):
+        n = 1
+        for var in con.scope:
+            n *= len(var.dom)
+        return n
+
+def compile_csp(csp, table_limit=10000):
+    '''Return the CompiledCSP of csp'''
+    return CompiledCSP(csp, table_limit)
+
+class CompiledSolver:
+    '''Backtracking search with GAC propagation and MRV variable
+       ordering over a CompiledCSP. Same statistics as BT: nDecisions,
+       nPrunings, nSolutions, runtime.'''
+
+    def __init__(self, compiled):
+        self.cc = compiled
+        self.nDecisions = 0
+        self.nPrunings = 0
+        self.nSolutions = 0
+        self.runtime = 0
+
+    def clear_stats(self):
+        self.nDecisions = 0
+        self.nPrunings = 0
+        self.nSolutions = 0
+        self.runtime = 0
+
+    def solve(self):
+        '''Find a solution and assign it to the Variables of the CSP.
+           Returns True if there is one, False otherwise.'''
+        soln = next(self.solutions(limit=1), None)
+        if soln is None:
+            return False
+        for var, val in zip(self.cc.vars, soln):
+            if not var.is_assigned():
+                var.assign(val)
+        return True
+
+    def count(self, limit=None):
+        '''Number of solutions (stops counting at limit)'''
+        n = 0
+        for soln in self.solutions(limit):
+            n += 1
+        return n
+
+    def solutions(self, limit=None):
+        '''Generator of the solutions, each a list of values in CSP
+           variable order'''
+        stime = time.process_time()
+        self.clear_stats()
+        try:
+            for dom in self._search():
+                self.nSolutions += 1
+                yield [vals[m.bit_length() - 1]
+                       for vals, m in zip(self.cc.values, dom)]
+                if limit is not None and self.nSolutions >= limit:
+                    return
+        finally:
+            self.runtime = time.process_time() - stime
+
+    #
+    #search on the arrays
+    #
+
+    def _search(self):
+        '''Yields the domain list each time every domain is a single
+           value'''
+        cc = self.cc
+        dom = list(cc.init)
+        self.dom = dom
+        self.trail = []
+        self.residues = [None if s is None else [[0] * len(p) for p in s]
+                         for s in cc.supports]
+        trail = self.trail
+        if not self._propagate(range(len(cc.cons))):
+            return
+
+        #choice point == [variable, values (mask) not tried yet, trail size]
+        stack = []
+        v = self._select()
+        if v is None:
+            yield dom
+            return
+        stack.append([v, dom[v], len(trail)])
+        while stack:
+            frame = stack[-1]
+            v, untried, mark = frame
+            self._undo(mark)
+            if not untried:
+                stack.pop()
+                continue
+            bit = untried & -untried
+            frame[1] = untried ^ bit
+            self.nDecisions += 1
+            trail.append((v, dom[v]))
+            dom[v] = bit
+            if not self._propagate(cc.var_cons[v]):
+                continue
+            v = self._select()
+            if v is None:
+                yield dom
+                continue
+            stack.append([v, dom[v], len(trail)])
+
+    def _undo(self, mark):
+        dom = self.dom
+        trail = self.trail
+        while len(trail) > mark:
+            v, m = trail.pop()
+            dom[v] = m
+
+    def _select(self):
+        '''Unassigned variable with the fewest values (None if all
+           domains are single values)'''
+        best = None
+        best_size = None
+        for v, m in enumerate(self.dom):
+            if m & (m - 1):
+                sz = _popcount(m)
+                if best is None or sz < best_size:
+                    best = v
+                    best_size = sz
+                    if sz == 2:
+                        break
+        return best
+
+    def _set(self, v, new):
+        '''Shrink the domain of v to new (a subset), for the trail'''
+        old = self.dom[v]
+        self.trail.append((v, old))
+        self.dom[v] = new
+        self.nPrunings += _popcount(old ^ new)
+
+    def _propagate(self, cons):
+        '''Make the queued constraints (and those they wake up) GAC.
+           Returns False on a domain wipeout.'''
+        cc = self.cc
+        dom = self.dom
+        queue = list(cons)
+        queued = set(queue)
+        revise = (self._revise_binary, self._revise_table,
+                  self._revise_filter, self._revise_check)
+        kind = cc.kind
+        var_cons = cc.var_cons
+        while queue:
+            c = queue.pop()
+            queued.discard(c)
+            changed = revise[kind[c]](c, dom)
+            if changed is None:
+                return False
+            for v in changed:
+                for c2 in var_cons[v]:
+                    if c2 != c and c2 not in queued:
+                        queue.append(c2)
+                        queued.add(c2)
+        return True
+
+    def _revise_binary(self, c, dom):
+        x, y = self.cc.scope[c]
+        masks = self.cc.masks[c]
+        changed = []
+        for pos, v, w in ((0, x, y), (1, y, x)):
+            m = dom[v]
+            other = dom[w]
+            if _popcount(other) <= _popcount(m):
+                sup = masks[1 - pos]
+                u = 0
+                while other:
+                    low = other & -other
+                    u |= sup[low.bit_length() - 1]
+                    other ^= low
+                new = m & u
+            else:
+                sup = masks[pos]
+                new = m
+                bits = m
+                while bits:
+                    low = bits & -bits
+                    if not sup[low.bit_length() - 1] & other:
+                        new ^= low
+                    bits ^= low
+            if new != m:
+                if not new:
+                    return None
+                self._set(v, new)
+                changed.append(v)
+        return changed
+
+    def _revise_table(self, c, dom):
+        scope = self.cc.scope[c]
+        tuples = self.cc.tuples[c]
+        supports = self.cc.supports[c]
+        residues = self.residues[c]
+        changed = []
+        for pos, v in enumerate(scope):
+            m = dom[v]
+            new = m
+            bits = m
+            while bits:
+                low = bits & -bits
+                k = low.bit_length() - 1
+                bits ^= low
+                sup = supports[pos][k]
+                n = len(sup)
+                start = residues[pos][k]
+                for step in range(n):
+                    i = (start + step) % n
+                    t = tuples[sup[i]]
+                    for p, w in enumerate(scope):
+                        if not (dom[w] >> t[p]) & 1:
+                            break
+                    else:
+                        residues[pos][k] = i
+                        break
+                else:
+                    new ^= low
+            if new != m:
+                if not new:
+                    return None
+                self._set(v, new)
+                changed.append(v)
+        return changed
+
+    def _revise_filter(self, c, dom):
+        scope = self.cc.scope[c]
+        sup = self.cc.cons[c].filter_masks([dom[v] for v in scope])
+        if sup is None:
+            return None
+        changed = []
+        for v, new in zip(scope, sup):
+            if new != dom[v]:
+                if not new:
+                    return None
+                self._set(v, new)
+                changed.append(v)
+        return changed
+
+    def _revise_check(self, c, dom):
+        '''Check the constraint once all values are fixed, and keep only
+           the values that satisfy it once one variable is left'''
+        scope = self.cc.scope[c]
+        values = self.cc.values
+        vals = []
+        free = None
+        for pos, v in enumerate(scope):
+            m = dom[v]
+            if m & (m - 1):
+                if free is not None:
+                    return []
+                free = pos
+                vals.append(None)
+            else:
+                vals.append(values[v][m.bit_length() - 1])
+        con = self.cc.cons[c]
+        if free is None:
+            return [] if con.check(vals) else None
+        v = scope[free]
+        m = dom[v]
+        new = m
+        bits = m
+        while bits:
+            low = bits & -bits
+            vals[free] = values[v][low.bit_length() - 1]
+            if not con.check(vals):
+                new ^= low
+            bits ^= low
+        if new == m:
+            return []
+        if not new:
+            return None
+        self._set(v, new)
+        return [v]
@@ -0,0 +1,469 @@
+'''Parallel solving routines
+
+   A) portfolio_solve
+
+      Runs several differently configured BT searches (propagator and
+      BT options) on the same CSP, each in its own process, and returns
+      the answer of the first one to finish. The others are terminated.
+      The result says which configuration won, which is what we use to
+      pick defaults for a workload.
+
+   B) parallel_search
+
+      Splits one search over several worker processes. The first few
+      MRV decisions are expanded breadth first into subproblems (each a
+      list of (variable index, value) decisions from the root) which go
+      on a shared task queue. A worker that runs out of work says it is
+      hungry and a busy worker then gives away the untried values of
+      its shallowest open choice point as new subproblems (work
+      stealing). Works in first-solution and all-solutions modes; the
+      nDecisions/nPrunings of all workers are added up (in mode 'all'
+      they are those of the sequential bt_count). If a worker raises or
+      dies the others are stopped and the failure is reported.
+
+   Each worker process gets its own copy of the CSP (inherited on fork,
+   pickled otherwise, so predicates of PredicateConstraints must then be
+   picklable, e.g. module level functions or functools.partial).
+'''
+
+import multiprocessing
+import multiprocessing.connection
+import queue
+import time
+
+from cspbase import *
+from propagators import *
+
+#(name, propagator, keyword arguments for BT)
+DEFAULT_PORTFOLIO = [
+    ('FC', prop_FC, {}),
+    ('GAC', prop_GAC, {}),
+    ('CT', prop_CT, {}),
+    ('GAC-degree', prop_GAC, {'degree_tiebreak': True}),
+]
+
+def _portfolio_worker(conn, csp, index, propagator, bt_options):
+    '''Solve csp with one configuration, send back
+       (index, status, values in csp.vars order, nDecisions, nPrunings,
+       runtime), or (index, 'error', message) on an exception'''
+    try:
+        solver = BT(csp, **bt_options)
+        soln = next(solver.bt_solutions(propagator, limit=1), None)
+        values = None
+        if soln is not None:
+            values = [soln[var] for var in csp.vars]
+        conn.send((index, soln is not None, values, solver.nDecisions,
+                   solver.nPrunings, solver.runtime))
+    except Exception as e:
+        conn.send((index, 'error', repr(e)))
+    conn.close()
+
+def portfolio_solve(csp, configs=None, timeout=None, processes=None):
+    '''Race the configurations (list of (name, propagator, BT keyword
+       arguments), default DEFAULT_PORTFOLIO) on csp using at most
+       processes worker processes (default: one per configuration, at
+       most the number of CPUs). The first configuration to find a
+       solution or prove there is none wins and the other workers are
+       terminated. A configuration that raises is skipped and the next
+       waiting one (if any) is started.
+
+       Returns a dict with keys
+           'config'     name of the winning configuration (None if none
+                        finished within timeout seconds)
+           'solved'     True/False (None if no winner)
+           'solution'   dict Variable --> value of csp's own variables
+                        (these are also assigned, as after bt_search)
+           'nDecisions', 'nPrunings', 'runtime'   the winner's statistics
+           'wall'       seconds until the winner answered
+           'errors'     dict config name --> error message'''
+    if configs is None:
+        configs = DEFAULT_PORTFOLIO
+    if processes is None:
+        processes = min(len(configs), multiprocessing.cpu_count())
+    processes = max(1, processes)
+
+    ctx = multiprocessing.get_context()
+    start = time.perf_counter()
+    waiting = list(range(len(configs)))
+    running = dict()        #connection --> (process, index)
+    result = {'config': None, 'solved': None, 'solution': None,
+              'nDecisions': None, 'nPrunings': None, 'runtime': None,
+              'wall': None, 'errors': dict()}
+
+    def launch():
+        while waiting and len(running) < processes:
+            index = waiting.pop(0)
+            name, propagator, bt_options = configs[index]
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_portfolio_worker,
+                               args=(send, csp, index, propagator, bt_options))
+            proc.daemon = True
+            proc.start()
+            send.close()
+            running[recv] = (proc, index)
+
+    try:
+        launch()
+        while running:
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+            ready = multiprocessing.connection.wait(list(running), remaining)
+            if not ready:
+                break
+            for conn in ready:
+                proc, index = running.pop(conn)
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    msg = (index, 'error', 'worker exited with code {}'.format(
+                        proc.exitcode))
+                conn.close()
+                proc.join()
+                if msg[1] == 'error':
+                    result['errors'][configs[index][0]] = msg[2]
+                    continue
+                index, status, values, nDecisions, nPrunings, runtime = msg
+                result.update(config=configs[index][0], solved=status,
+                              nDecisions=nDecisions, nPrunings=nPrunings,
+                              runtime=runtime,
+                              wall=time.perf_counter() - start)
+                if status:
+                    for var in csp.vars:
+                        if var.is_assigned():
+                            var.unassign()
+                    result['solution'] = dict()
+                    for var, val in zip(csp.vars, values):
+                        var.assign(val)
+                        result['solution'][var] = val
+                return result
+            launch()
+        return result
+    finally:
+        #cancel the losers
+        for conn, (proc, index) in running.items():
+            proc.terminate()
+        for conn, (proc, index) in running.items():
+            proc.join()
+            conn.close()
+
+
+def _split(csp, propagator, bt_options, ntasks):
+    '''Expand the search tree breadth first, one MRV variable per
+       level, until there are at least ntasks open subproblems (or none
+       left). Returns (subproblems, solutions found on the way as lists
+       of values, nDecisions, nPrunings).'''
+    solver = BT(csp, **bt_options)
+    index = dict()
+    for i, var in enumerate(csp.vars):
+        index[var] = i
+    frontier = [[]]
+    costs = []          #prunings of the last decision of each subproblem
+    solutions = []
+    nDecisions = 0
+    nPrunings = 0
+    while frontier and len(frontier) < ntasks:
+        nxt = []
+        nxt_costs = []
+        for prefix in frontier:
+            if not solver.start_search(propagator):
+                #no solution: leave the variables as they were, like
+                #the normal path does
+                solver.finish_search(0)
+                solver.restore_all_variable_domains()
+                return [], [], nDecisions, solver.nPrunings
+            if not prefix:
+                #the root propagation, counted once as bt_count does
+                nPrunings += solver.trail.nPrunings
+            solver.push_decisions(propagator,
+                                  [(csp.vars[i], val) for i, val in prefix])
+            if not solver.unasgn_vars:
+                #nothing left to decide after the root propagation
+                solutions.append([v.get_assigned_value() for v in csp.vars])
+                solver.finish_search(0)
+                continue
+            var = solver.extractMRVvar()
+            for val in var.cur_domain():
+                nDecisions += 1
+                before = solver.trail.nPrunings
+                if solver.push_decisions(propagator, [(var, val)]):
+                    if not solver.unasgn_vars:
+                        solutions.append([v.get_assigned_value() for v in csp.vars])
+                    else:
+                        nxt.append(prefix + [(index[var], val)])
+                        nxt_costs.append(solver.trail.nPrunings - before)
+                nPrunings += solver.trail.nPrunings - before
+                solver.trail.pop_level()
+                var.unassign()
+            solver.finish_search(0)
+        frontier = nxt
+        costs = nxt_costs
+    solver.restore_all_variable_domains()
+    #the worker that solves a subproblem counts its last decision, as
+    #for subproblems given away during the search
+    nDecisions -= len(costs)
+    nPrunings -= sum(costs)
+    return frontier, solutions, nDecisions, nPrunings
+
+def _search_worker(wid, csp, propagator, bt_options, first, collect,
+                   tasks, results, shared):
+    '''Worker process of parallel_search. shared == (lock, pending,
+       queued, hungry, stop): pending counts subproblems not finished,
+       queued those waiting in tasks, hungry the idle workers.
+       Sends ('done', wid, stats, solutions) at the end, or
+       ('error', wid, message) on an exception.'''
+    lock, pending, queued, hungry, stop = shared
+    tasks.cancel_join_thread()      #donations may be left unread at the end
+    vars = csp.vars
+    index = dict()
+    for i, var in enumerate(vars):
+        index[var] = i
+    task = None
+    stats = {'nDecisions': 0, 'nPrunings': 0, 'nSolutions': 0, 'nSteals': 0,
+             'nDonated': 0}
+    solutions = []
+    nodes = [0]
+
+    def donate():
+        '''Give the untried values of the shallowest open choice point
+           away as subproblems'''
+        stack = solver.stack
+        for depth, frame in enumerate(stack):
+            if frame[2] < len(frame[1]):
+                break
+        else:
+            return
+        prefix = list(task)
+        for f in stack[:depth]:
+            prefix.append((index[f[0]], f[0].get_assigned_value()))
+        i = index[frame[0]]
+        new = [prefix + [(i, val)] for val in frame[1][frame[2]:]]
+        if solver.restarts is not None:
+            #a restart rebuilds the choice points from the root of the
+            #task; the nogoods keep it out of what was given away
+            path = [(f[0], f[0].get_assigned_value()) for f in stack[:depth]]
+            for val in frame[1][frame[2]:]:
+                solver.nogoods.add(path + [(frame[0], val)])
+        del frame[1][frame[2]:]
+        with lock:
+            pending.value += len(new)
+            queued.value += len(new)
+        for t in new:
+            tasks.put(t)
+        stats['nSteals'] += 1
+        stats['nDonated'] += len(new)
+
+    def callback():
+        nodes[0] += 1
+        if nodes[0] % 16:
+            return False
+        if stop.is_set():
+            return True
+        if hungry.value > queued.value:
+            donate()
+        return False
+
+    try:
+        solver = BT(csp, **bt_options)
+        solver.node_callback = callback
+        waiting = False
+        while not stop.is_set():
+            try:
+                task = tasks.get(timeout=0.05)
+            except queue.Empty:
+                if not waiting:
+                    with lock:
+                        hungry.value += 1
+                    waiting = True
+                continue
+            if waiting:
+                with lock:
+                    hungry.value -= 1
+                waiting = False
+            if task is None:
+                break
+            with lock:
+                queued.value -= 1
+
+            if solver.start_search(propagator):
+                #replay the path to the subproblem; its last decision
+                #(and the root propagation for the whole problem) is
+                #counted here, the rest by the split or the donor
+                ok = solver.push_decisions(propagator,
+                                           [(vars[i], val) for i, val in task[:-1]])
+                before = solver.trail.nPrunings if task else 0
+                if ok and task:
+                    stats['nDecisions'] += 1
+                    i, val = task[-1]
+                    ok = solver.push_decisions(propagator, [(vars[i], val)])
+                if ok:
+                    for found in solver.bt_iterate(propagator):
+                        stats['nSolutions'] += 1
+                        values = [var.get_assigned_value() for var in vars]
+                        if first:
+                            results.put(('solution', wid, values))
+                            stop.set()
+                            break
+                        if collect:
+                            solutions.append(values)
+                stats['nDecisions'] += solver.nDecisions
+                stats['nPrunings'] += solver.trail.nPrunings - before
+            solver.finish_search(0)
+            with lock:
+                pending.value -= 1
+        results.put(('done', wid, stats, solutions))
+    except Exception as e:
+        results.put(('error', wid, repr(e)))
+
+def parallel_search(csp, propagator=prop_FC, workers=None, mode='first',
+                    collect=False, split_tasks=None, timeout=None,
+                    bt_options=None):
+    '''Search csp with propagator on workers processes (default: one
+       per CPU), splitting the search space as described above.
+
+       mode == 'first': stop at the first solution found by any worker;
+               it is assigned to csp's variables as after bt_search.
+       mode == 'all': explore everything and count the solutions;
+               collect=True also returns them all (as dicts).
+       split_tasks == subproblems to create before starting the workers
+               (default 4 per worker); idle workers steal the rest.
+       timeout == give up after this many seconds (the statistics are
+               those of the work done so far).
+       bt_options == dict of keyword arguments for the BT of the split
+               and of every worker (None: defaults).
+
+       Returns a dict with keys 'solved', 'solution' (dict Variable -->
+       value or None), 'nSolutions', 'solutions' (list of dicts, only if
+       collect), 'nDecisions', 'nPrunings' (summed over the split and
+       all workers), 'nTasks' (subproblems created), 'nSteals' (times
+       work was given away), 'timed_out', 'wall' and 'errors' (dict
+       worker number --> message of the workers that raised or died).
+       If a worker failed the search is stopped and, unless a solution
+       was found in mode 'first', 'solved' and 'nSolutions' are None
+       (and 'solutions' stays empty).'''
+    if mode not in ('first', 'all'):
+        raise ValueError("mode must be 'first' or 'all'")
+    if bt_options is None:
+        bt_options = dict()
+    first = mode == 'first'
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, workers)
+    if split_tasks is None:
+        split_tasks = 4 * workers
+
+    start = time.perf_counter()
+    subproblems, found, nDecisions, nPrunings = _split(
+        csp, propagator, bt_options, split_tasks)
+    result = {'solved': False, 'solution': None, 'nSolutions': len(found),
+              'solutions': [] if collect else None,
+              'nDecisions': nDecisions, 'nPrunings': nPrunings,
+              'nTasks': len(subproblems), 'nSteals': 0,
+              'timed_out': False, 'wall': None, 'errors': dict()}
+    solutions = list(found)
+
+    if subproblems and not (first and found):
+        ctx = multiprocessing.get_context()
+        lock = ctx.Lock()
+        pending = ctx.Value('l', len(subproblems), lock=False)
+        queued = ctx.Value('l', len(subproblems), lock=False)
+        hungry = ctx.Value('l', 0, lock=False)
+        stop = ctx.Event()
+        tasks = ctx.Queue()
+        tasks.cancel_join_thread()
+        results = ctx.Queue()
+        for t in subproblems:
+            tasks.put(t)
+        procs = []
+        for wid in range(workers):
+            proc = ctx.Process(target=_search_worker,
+                               args=(wid, csp, propagator, bt_options, first,
+                                     collect, tasks, results,
+                                     (lock, pending, queued, hungry, stop)))
+            proc.daemon = True
+            proc.start()
+            procs.append(proc)
+
+        done = 0
+        reported = set()
+        finishing = False
+        while done < workers:
+            if not finishing:
+                if timeout is not None and time.perf_counter() - start > timeout:
+                    result['timed_out'] = True
+                    stop.set()
+                    finishing = True
+                elif stop.is_set():
+                    finishing = True
+                else:
+                    with lock:
+                        idle = pending.value == 0
+                    if idle:
+                        for proc in procs:
+                            tasks.put(None)
+                        finishing = True
+            #a worker's last message is in results before it exits
+            dead = [wid for wid, proc in enumerate(procs)
+                    if wid not in reported and not proc.is_alive()]
+            try:
+                msg = results.get(timeout=0.05)
+            except queue.Empty:
+                for wid in dead:
+                    #killed without reporting (e.g. by a signal)
+                    result['errors'][wid] = 'worker exited with code {}'.format(
+                        procs[wid].exitcode)
+                    reported.add(wid)
+                    done += 1
+                    stop.set()
+                    finishing = True
+                continue
+            if msg[0] == 'solution':
+                if not solutions or not first:
+                    solutions.append(msg[2])
+                stop.set()
+            elif msg[0] == 'error':
+                #its subproblems are lost: stop the others
+                result['errors'][msg[1]] = msg[2]
+                reported.add(msg[1])
+                done += 1
+                stop.set()
+                finishing = True
+            else:
+                wid, stats, wsolutions = msg[1:]
+                result['nDecisions'] += stats['nDecisions']
+                result['nPrunings'] += stats['nPrunings']
+                result['nSteals'] += stats['nSteals']
+                result['nTasks'] += stats['nDonated']
+                if not first:
+                    result['nSolutions'] += stats['nSolutions']
+                    solutions.extend(wsolutions)
+                reported.add(wid)
+                done += 1
+        for proc in procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+    if first:
+        solutions = solutions[:1]
+        result['nSolutions'] = len(solutions)
+    result['solved'] = bool(solutions) or result['nSolutions'] > 0
+    if result['errors'] and not (first and solutions):
+        #part of the search space was not explored: no answer
+        result['wall'] = time.perf_counter() - start
+        result.update(solved=None, nSolutions=None)
+        return result
+    if collect:
+        result['solutions'] = [dict(zip(csp.vars, values)) for values in solutions]
+    if first and solutions:
+        result['solution'] = dict(zip(csp.vars, solutions[0]))
+        for var in csp.vars:
+            if var.is_assigned():
+                var.unassign()
+        for var, val in zip(csp.vars, solutions[0]):
+            var.assign(val)
+    result['wall'] = time.perf_counter() - start
+    return result
@@ -1,6 +1,6 @@
 from cspbase import *
 from propagators import *
-import itertools
+import functools
 
 x = Variable('X', [1, 2, 3])
 y = Variable('Y', [1, 2, 3])
@@ -19,21 +19,9 @@ c1 = Constraint('C1', [x, y, z])
 #c1 is constraint x == y + z. Below are all of the satisfying tuples
 c1.add_satisfying_tuples([[2, 1, 1], [3, 1, 2], [3, 2, 1]])
 
-c2 = Constraint('C2', [w, x, y, z])
 #c2 is constraint w == x + y + z. Instead of writing down the satisfying
-#tuples we compute them
-
-varDoms = []
-for v in [w, x, y, z]:
-    varDoms.append(v.domain())    
-
-sat_tuples = []
-for t in itertools.product(*varDoms):
-    #NOTICE use of * to convert the list v to a sequence of arguments to product
-    if w_eq_sum_x_y_z(t):
-        sat_tuples.append(t)
-
-c2.add_satisfying_tuples(sat_tuples)
+#tuples we give the function that tests them
+c2 = PredicateConstraint('C2', [w, x, y, z], w_eq_sum_x_y_z)
 
 simpleCSP = CSP("SimpleEqs", [x,y,z,w])
 simpleCSP.add_constraint(c1)
@@ -59,6 +47,10 @@ def queensCheck(qi, qj, i, j):
     '''
     return i != j and abs(i-j) != abs(qi-qj)
 
+def queensPredicate(qi, qj, vals):
+    '''queensCheck on the pair of values of a queens constraint'''
+    return queensCheck(qi, qj, vals[0], vals[1])
+
 def nQueens(n):
     '''Return an n-queens CSP'''
     i = 0
@@ -73,12 +65,9 @@ def nQueens(n):
     cons = []    
     for qi in range(len(dom)):
         for qj in range(qi+1, len(dom)):
-            con = Constraint("C(Q{},Q{})".format(qi+1,qj+1),[vars[qi], vars[qj]]) 
-            sat_tuples = []
-            for t in itertools.product(dom, dom):
-                if queensCheck(qi, qj, t[0], t[1]):
-                    sat_tuples.append(t)
-            con.add_satisfying_tuples(sat_tuples)
+            con = PredicateConstraint("C(Q{},Q{})".format(qi+1,qj+1),
+                                      [vars[qi], vars[qj]],
+                                      functools.partial(queensPredicate, qi, qj))
             cons.append(con)
     
     csp = CSP("{}-Queens".format(n), vars)
@@ -0,0 +1,608 @@
+'''On-disk storage of built CSPs
+
+   save_csp writes a CSP in a compact binary format and load_csp maps
+   it back into memory:
+
+       magic b'CSPS', version, header length    (3 x uint32)
+       header                                   (JSON)
+       data                                     (packed integer arrays)
+
+   The header has the variables (name and domain), and for every
+   constraint its name, kind ('table', 'alldiff' or 'inequality'), the
+   position of its scope in the scope array and its table number (the
+   ops string for an inequality chain). Scopes are one
+   int32 array of variable numbers. Each distinct table is stored once
+   (model 2 puts the same n! permutations on every row and column) as
+   an ntuples x arity matrix of codes into the table's list of values,
+   one byte per code if it has at most 256 values. The header also has
+   the SHA-1 of the scope array and of every table: load_csp rejects
+   (ValueError) a file that is truncated or whose scopes do not match,
+   and a table is checked when it is first decoded.
+
+   load_csp memory-maps the file, so loading costs only the header:
+   tables are read (and their pages shared between processes that load
+   the same file) when a constraint first needs its tuples, see
+   PackedTableConstraint. Sharing stops there: the first time a table
+   is used each process decodes all of it into Python tuples and a
+   Relation (one copy per table, not per constraint), so a solving
+   process still pays for the tables it propagates. Tables that must
+   never be decoded belong in MappedTableConstraint (below).
+
+   cached_model(generator, board) returns generator(board) (a model
+   function such as futoshiki_csp_model_2, returning (csp, var_arr)),
+   loading it from the cache if the same generator has already been
+   run on a board of the same size and contents, and saving it there
+   otherwise. The cache key also has the file format VERSION and, if the
+   generator's module has a model_options() function, the settings it
+   returns (e.g. futoshiki_csp.BOUNDS_INEQUALITIES and its model
+   version), so changing those never loads a model built without them.
+   A cached file load_csp rejects is built and saved again.
+
+   For extensional constraints too big to keep as Python tuples at all,
+   write_table stores a table as a packed matrix with hash and column
+   index files, and MappedTableConstraint checks and finds supports
+   directly in the memory-mapped files.
+'''
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from cspbase import *
+
+MAGIC = b'CSPS'
+VERSION = 2
+_PREFIX = struct.Struct('<4sII')
+
+def _typecode(nvalues):
+    '''array typecode for codes 0..nvalues-1'''
+    if nvalues <= 1 << 8:
+        return 'B'
+    if nvalues <= 1 << 16:
+        return 'H'
+    return 'I'
+
+def _align(n):
+    return (n + 7) & ~7
+
+class PackedTable:
+    '''A table stored as a matrix of value codes (see module doc).
+       codes is a memoryview (or array) of ntuples * arity codes.'''
+
+    def __init__(self, arity, ntuples, values, codes, path=None, offset=None,
+                 digest=None):
+        self.arity = arity
+        self.ntuples = ntuples
+        self.values = values
+        self.codes = codes
+        self.path = path        #file and byte offset the codes are
+        self.offset = offset    #mapped from, used when pickling
+        self.digest = digest    #SHA-1 (hex) of the codes, if known
+        self._tuples = None
+        self._relation = None
+
+    def verify(self):
+        '''Raise ValueError if the codes do not match digest'''
+        if (self.digest is not None and
+                hashlib.sha1(self.codes).hexdigest() != self.digest):
+            raise ValueError("table at byte {} of {} is corrupt".format(
+                self.offset, self.path))
+
+    def relation(self):
+        '''Relation of the table, built on first use and shared by all
+        the constraints on this table'''
+        if self._relation is None:
+            self._relation = Relation(self.tuples())
+        return self._relation
+
+    def tuples(self):
+        '''List of the tuples (of values), decoded on first use (into
+        this process's memory, the mapped pages are not used after)'''
+        if self._tuples is None:
+            self.verify()
+            values = self.values
+            decoded = [values[k] for k in self.codes]
+            a = self.arity
+            self._tuples = [tuple(decoded[i:i+a])
+                            for i in range(0, len(decoded), a)]
+        return self._tuples
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_tuples'] = None
+        state['_relation'] = None
+        if self.path is not None:
+            state['codes'] = None   #mapped again on unpickling
+        else:
+            state['codes'] = array.array(_typecode(len(self.values)),
+                                         self.codes)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.codes is None:
+            self.codes = _view(_map_file(self.path), self.offset,
+                               _typecode(len(self.values)),
+                               self.ntuples * self.arity)
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _view(mm, offset, typecode, n):
+    '''n integers of type typecode at byte offset of mm'''
+    size = array.array(typecode).itemsize
+    return memoryview(mm)[offset:offset + n*size].cast(typecode)
+
+class PackedTableConstraint(Constraint):
+    '''Table constraint whose tuples are in a PackedTable. sat_tuples
+       and sup_tuples are only filled in (from the table) the first time
+       they are used, so loading a stored CSP is cheap and constraints
+       that are never propagated cost nothing. Constraints on the same
+       table share its Relation (see Constraint.set_relation).'''
+
+    def __init__(self, name, scope, table):
+        self.table = table
+        self._loaded = False
+        Constraint.__init__(self, name, scope)
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            self.set_relation(self.table.relation())
+
+    @property
+    def sat_tuples(self):
+        self._load()
+        return self._sat_tuples
+
+    @sat_tuples.setter
+    def sat_tuples(self, value):
+        self._sat_tuples = value
+
+    @property
+    def sup_tuples(self):
+        self._load()
+        return self._sup_tuples
+
+    @sup_tuples.setter
+    def sup_tuples(self, value):
+        self._sup_tuples = value
+
+    def add_satisfying_tuples(self, tuples):
+        self._load()
+        Constraint.add_satisfying_tuples(self, tuples)
+
+def _table_of(c):
+    '''(arity, values, codes array) of table constraint c'''
+    if isinstance(c, PackedTableConstraint) and not c._loaded:
+        t = c.table
+        t.verify()
+        return t.arity, t.values, array.array(_typecode(len(t.values)), t.codes)
+    tuples = list(c.sat_tuples)
+    values = []
+    code = dict()
+    for t in tuples:
+        for val in t:
+            if val not in code:
+                code[val] = len(values)
+                values.append(val)
+    codes = array.array(_typecode(len(values)))
+    for t in tuples:
+        codes.extend(code[val] for val in t)
+    return len(c.scope), values, codes
+
+def save_csp(csp, path, layout=None):
+    '''Write csp to path. layout == optional list of lists of csp
+       variables (e.g. the var_arr of a futoshiki model), stored as
+       variable numbers and returned again by load_csp.
+       Raises ValueError for constraints other than tables,
+       all-different and inequality constraints, or values JSON cannot
+       store.'''
+    number = dict()
+    for i, var in enumerate(csp.vars):
+        number[var] = i
+    header = {'name': csp.name,
+              'vars': [[var.name, list(var.dom)] for var in csp.vars],
+              'cons': [], 'tables': []}
+    if layout is not None:
+        header['layout'] = [[number[var] for var in row] for row in layout]
+
+    scopes = array.array('i')
+    chunks = []     #(table header entry, codes)
+    table_ids = dict()
+    for c in csp.cons:
+        entry = [c.name, None, len(scopes), len(c.scope), None]
+        scopes.extend(number[var] for var in c.scope)
+        if isinstance(c, AllDiffConstraint):
+            entry[1] = 'alldiff'
+        elif isinstance(c, InequalityConstraint):
+            entry[1] = 'inequality'
+            entry[4] = c.ops
+        elif type(c) in (Constraint, PackedTableConstraint):
+            entry[1] = 'table'
+            arity, values, codes = _table_of(c)
+            key = (arity, json.dumps(values),
+                   hashlib.sha1(codes.tobytes()).hexdigest())
+            if key not in table_ids:
+                table_ids[key] = len(chunks)
+                chunks.append(([arity, len(codes) // max(1, arity),
+                                values, None, key[2]], codes))
+            entry[4] = table_ids[key]
+        else:
+            raise ValueError("cannot store constraint {} of type {}".format(
+                c.name, type(c).__name__))
+        header['cons'].append(entry)
+
+    #data: scope array, then the tables, each 8 byte aligned
+    offset = _align(len(scopes) * scopes.itemsize)
+    header['scopes'] = [0, len(scopes),
+                        hashlib.sha1(scopes.tobytes()).hexdigest()]
+    for entry, codes in chunks:
+        entry[3] = offset
+        header['tables'].append(entry)
+        offset = _align(offset + len(codes) * codes.itemsize)
+
+    text = json.dumps(header).encode('utf-8')
+    start = _align(_PREFIX.size + len(text))
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(text)))
+        f.write(text)
+        f.write(b'\0' * (start - _PREFIX.size - len(text)))
+        parts = [scopes] + [codes for entry, codes in chunks]
+        for part in parts:
+            data = part.tobytes()
+            f.write(data)
+            f.write(b'\0' * (_align(len(data)) - len(data)))
+    os.replace(tmp, path)   #readers never see a partial file
+
+def load_csp(path):
+    '''Return (csp, layout) stored in path by save_csp (layout is
+       None if none was saved). Tables are memory-mapped, not read.
+       Raises ValueError if path is not a CSP file of this VERSION or is
+       truncated or corrupt.'''
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ValueError("{} is not a CSP file".format(path))
+        magic, version, hlen = _PREFIX.unpack(prefix)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} CSP file".format(
+                path, VERSION))
+        try:
+            header = json.loads(f.read(hlen).decode('utf-8'))
+            sstart, slen, sdigest = header['scopes']
+            tables = header['tables']
+            ends = [sstart + 4*slen]
+            for arity, ntuples, values, offset, digest in tables:
+                ends.append(offset + ntuples * arity *
+                            array.array(_typecode(len(values))).itemsize)
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError("{} has a corrupt header: {!r}".format(path, e))
+    start = _align(_PREFIX.size + hlen)
+    if os.path.getsize(path) < start + max(ends):
+        raise ValueError("{} is truncated".format(path))
+
+    vars = [Variable(name, dom) for name, dom in header['vars']]
+    csp = CSP(header['name'], vars)
+    mm = _map_file(path)
+    scopes = _view(mm, start + sstart, 'i', slen)
+    if hashlib.sha1(scopes).hexdigest() != sdigest:
+        raise ValueError("{} has corrupt scopes".format(path))
+    packed = []
+    for arity, ntuples, values, offset, digest in tables:
+        codes = _view(mm, start + offset, _typecode(len(values)),
+                      ntuples * arity)
+        packed.append(PackedTable(arity, ntuples, values, codes,
+                                  path, start + offset, digest))
+    for name, kind, soff, arity, table in header['cons']:
+        scope = [vars[i] for i in scopes[soff:soff + arity]]
+        if kind == 'alldiff':
+            c = AllDiffConstraint(name, scope)
+        elif kind == 'inequality':
+            c = InequalityConstraint(name, scope, table)
+        else:
+            c = PackedTableConstraint(name, scope, packed[table])
+        csp.add_constraint(c)
+
+    layout = header.get('layout')
+    if layout is not None:
+        layout = [[vars[i] for i in row] for row in layout]
+    return csp, layout
+
+def default_cache_dir():
+    '''$CSP_CACHE_DIR, or ~/.cache/csp_models'''
+    return os.environ.get('CSP_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'csp_models'))
+
+def model_options(generator):
+    '''Settings of the generator's module that change the models it
+       builds: the result of its model_options() function (None if it
+       has none)'''
+    options = getattr(sys.modules.get(generator.__module__),
+                      'model_options', None)
+    if options is None:
+        return None
+    return options()
+
+def cache_path(generator, board, cache_dir=None):
+    '''File the model generator(board) is cached in'''
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    key = {'board': board, 'options': model_options(generator)}
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, '{}.{}-n{}-v{}-{}.csp'.format(
+        generator.__module__, generator.__name__, len(board), VERSION,
+        digest.hexdigest()[:16]))
+
+def cached_model(generator, board, cache_dir=None):
+    '''Return generator(board) == (csp, var_arr), from the cache if
+       possible'''
+    path = cache_path(generator, board, cache_dir)
+    if os.path.exists(path):
+        try:
+            return load_csp(path)
+        except ValueError:
+            pass        #damaged: build it again
+    csp, var_arr = generator(board)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_csp(csp, path, var_arr)
+    return csp, var_arr
+
+#
+#memory-mapped tables for constraints too big for the Python heap
+#
+
+def _write_array(path, arr):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        arr.tofile(f)
+    os.replace(tmp, path)
+
+def _row_typecode(n):
+    return 'I' if n < 1 << 32 else 'Q'
+
+#hash of the .hix files, recorded in the .json header. It must give the
+#same value in every Python version and process, which hash() of a tuple
+#does not promise.
+HASH_SCHEME = 'fnv1a64'
+_FNV_OFFSET = 0xcbf29ce484222325
+_FNV_PRIME = 0x100000001b3
+_MASK64 = (1 << 64) - 1
+
+def _hash_codes(codes):
+    '''64 bit FNV-1a hash of a sequence of value codes'''
+    h = _FNV_OFFSET
+    for k in codes:
+        h = ((h ^ k) * _FNV_PRIME) & _MASK64
+    return h
+
+def write_table(path, tuples, values=None):
+    '''Store the tuples (any iterable, read once) as a MappedTable at
+       path (files path.json, path.tbl, path.hix and path.cix):
+
+           .tbl   ntuples x arity matrix of value codes
+           .hix   open addressing hash table of row numbers + 1 (0 ==
+                  empty slot), for check, keyed on the HASH_SCHEME hash
+                  of the row's codes
+           .cix   for each column, the row numbers sorted by value code
+                  and the offset of each code's rows, for supports
+
+       values == list of the values that may occur (codes are positions
+       in it), default: in order of first occurrence. Duplicate tuples
+       are not removed. Only arrays of integers are kept in memory while
+       writing. Returns the number of tuples.'''
+    code = dict()
+    if values is not None:
+        values = list(values)
+        for k, val in enumerate(values):
+            code[val] = k
+    else:
+        values = []
+    codes = array.array('I')
+    arity = None
+    for t in tuples:
+        t = tuple(t)
+        if arity is None:
+            arity = len(t)
+        elif len(t) != arity:
+            raise ValueError("tuple {} does not have arity {}".format(t, arity))
+        for val in t:
+            k = code.get(val)
+            if k is None:
+                k = code[val] = len(values)
+                values.append(val)
+            codes.append(k)
+    if arity is None:
+        arity = 0
+    ntuples = len(codes) // arity if arity else 0
+    typecode = _typecode(len(values))
+    if typecode != 'I':
+        codes = array.array(typecode, codes)
+
+    #hash index, load factor at most 1/2
+    nslots = 1
+    while nslots < 2 * ntuples:
+        nslots <<= 1
+    rtype = _row_typecode(ntuples + 1)
+    slots = array.array(rtype, bytes(nslots * array.array(rtype).itemsize))
+    mask = nslots - 1
+    for r in range(ntuples):
+        i = _hash_codes(codes[r*arity:(r+1)*arity]) & mask
+        while slots[i]:
+            i = (i + 1) & mask
+        slots[i] = r + 1
+
+    #column index: offsets (len(values) + 1) then rows, for each column
+    cix = array.array(rtype)
+    nvalues = len(values)
+    for pos in range(arity):
+        counts = [0] * (nvalues + 1)
+        for r in range(ntuples):
+            counts[codes[r*arity + pos] + 1] += 1
+        for k in range(nvalues):
+            counts[k+1] += counts[k]
+        rows = array.array(rtype, bytes(ntuples * cix.itemsize))
+        fill = counts[:nvalues]
+        for r in range(ntuples):
+            k = codes[r*arity + pos]
+            rows[fill[k]] = r
+            fill[k] += 1
+        cix.extend(counts)
+        cix.extend(rows)
+
+    _write_array(path + '.tbl', codes)
+    _write_array(path + '.hix', slots)
+    _write_array(path + '.cix', cix)
+    header = {'arity': arity, 'ntuples': ntuples, 'values': values,
+              'nslots': nslots, 'hash': HASH_SCHEME}
+    tmp = '{}.json.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp, path + '.json')
+    return ntuples
+
+class MappedTable:
+    '''A table written by write_table, memory-mapped: the tuples are
+       never loaded onto the Python heap, pages are read from disk (and
+       shared between processes) as lookups touch them.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._map()
+
+    def _map(self):
+        with open(self.path + '.json') as f:
+            header = json.load(f)
+        if header.get('hash') != HASH_SCHEME:
+            raise ValueError("{} was indexed with hash {!r}, not {!r}: write "
+                             "it again with write_table".format(
+                                 self.path, header.get('hash'), HASH_SCHEME))
+        self.arity = header['arity']
+        self.ntuples = header['ntuples']
+        self.values = header['values']
+        self.nslots = header['nslots']
+        self.code = dict()
+        for k, val in enumerate(self.values):
+            self.code.setdefault(val, k)
+        rtype = _row_typecode(self.ntuples + 1)
+        self.codes = self._load(self.path + '.tbl', _typecode(len(self.values)))
+        self.slots = self._load(self.path + '.hix', rtype)
+        self.cix = self._load(self.path + '.cix', rtype)
+
+    def _load(self, path, typecode):
+        if os.path.getsize(path) == 0:
+            return array.array(typecode)    #mmap cannot map empty files
+        return memoryview(_map_file(path)).cast(typecode)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._map()
+
+    def __len__(self):
+        return self.ntuples
+
+    def row(self, r):
+        '''codes of tuple number r'''
+        a = self.arity
+        return tuple(self.codes[r*a:(r+1)*a])
+
+    def contains_codes(self, codes):
+        '''True iff the tuple of codes is in the table'''
+        if not self.ntuples:
+            return False
+        mask = self.nslots - 1
+        i = _hash_codes(codes) & mask
+        slots = self.slots
+        while slots[i]:
+            if self.row(slots[i] - 1) == codes:
+                return True
+            i = (i + 1) & mask
+        return False
+
+    def rows_with(self, pos, code):
+        '''row numbers of the tuples with value code at column pos'''
+        base = pos * (len(self.values) + 1 + self.ntuples)
+        cix = self.cix
+        start = cix[base + code]
+        end = cix[base + code + 1]
+        first = base + len(self.values) + 1
+        return cix[first + start:first + end]
+
+class MappedTableConstraint(Constraint):
+    '''Table constraint over a MappedTable: check is a hash lookup and
+       has_support scans the rows of the table with the value (from the
+       column index), starting at the residue, testing each against the
+       current domains. sat_tuples stays empty, so propagators that
+       need a table in memory (prop_CT) revise it with has_support
+       instead. Column pos of the table is scope position pos.'''
+
+    def __init__(self, name, scope, table):
+        Constraint.__init__(self, name, scope)
+        if table.arity != len(self.scope):
+            print("Trying to use a table of arity", table.arity,
+                  "for constraint", self)
+        self.table = table
+        self.position = dict()
+        for pos, var in enumerate(self.scope):
+            self.position.setdefault(var, pos)
+        #code --> dom index of the scope variable at each position (-1:
+        #value not in its domain)
+        self.dom_pos = [[var.dom_index.get(val, -1) for val in table.values]
+                        for var in self.scope]
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported, write a new table with write_table'''
+        print("Trying to add satisfying tuples to mapped table constraint ", self)
+
+    def check(self, vals):
+        codes = []
+        for val in vals:
+            k = self.table.code.get(val)
+            if k is None:
+                return False
+            codes.append(k)
+        return self.table.contains_codes(tuple(codes))
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple whose
+           values are all still in the current domains'''
+        self.nSupportCalls += 1
+        code = self.table.code.get(val)
+        if code is None or var not in self.position:
+            return False
+        key = (var, val)
+        rows = self.table.rows_with(self.position[var], code)
+        n = len(rows)
+        if not n:
+            return False
+        masks = [v.cur_mask() for v in self.scope]
+        dom_pos = self.dom_pos
+        codes = self.table.codes
+        a = self.table.arity
+        start = self.residues.get(key, 0) if Constraint.use_residues else 0
+        for step in range(n):
+            i = (start + step) % n
+            r = rows[i] * a
+            for p in range(a):
+                d = dom_pos[p][codes[r + p]]
+                if d < 0 or not (masks[p] >> d) & 1:
+                    break
+            else:
+                self.nTupleChecks += step + 1
+                if step == 0:
+                    self.nResidueHits += 1
+                else:
+                    self.residues[key] = i
+                return True
+        self.nTupleChecks += n
+        return False
@@ -1,5 +1,10 @@
 import time
+import bisect
 import functools
+import heapq
+import itertools
+import random
+from collections import OrderedDict
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -11,7 +16,8 @@ import functools
       added but NOT deleted from.
       
       To support constraint propagation, the class also maintains a
-      set of flags to indicate if a value is still in its current domain.
+      bitmask (one bit per domain value) to indicate if a value is still
+      in its current domain.
       So one can remove values, add them back, and query if they are 
       still current. 
 
@@ -30,12 +36,69 @@ import functools
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
+      class PredicateConstraint instead tests assignments with a
+      Python function, so its tuples never have to be enumerated.
+      class AllDiffConstraint is the global all-different constraint.
+
     C) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
        executed depending on the propagator used.
 
 '''
 
+def _popcount(m):
+    '''Number of set bits in the integer m'''
+    return bin(m).count('1')
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+
+#domain events a constraint can ask to be woken up by (bit flags, see
+#Constraint.events and propagators.PropagationEngine)
+REMOVED = 1     #some value was removed from the current domain
+BOUNDS = 2      #the smallest or largest current value changed
+ASSIGNED = 4    #a single value is left (or the variable was assigned)
+
+def _is_sorted(vals):
+    '''True if vals is in non-decreasing order (False if the values
+       cannot be compared)'''
+    try:
+        return all(vals[i] <= vals[i+1] for i in range(len(vals) - 1))
+    except TypeError:
+        return False
+
+def _mask_min(var, m):
+    '''Smallest value of var among the domain positions set in m'''
+    if var._sorted:
+        return var.dom[(m & -m).bit_length() - 1]
+    return min(var.dom[i] for i in range(m.bit_length()) if m >> i & 1)
+
+def _mask_max(var, m):
+    '''Largest value of var among the domain positions set in m'''
+    if var._sorted:
+        return var.dom[m.bit_length() - 1]
+    return max(var.dom[i] for i in range(m.bit_length()) if m >> i & 1)
+
+def _mask_above(var, value):
+    '''Mask of the domain positions of var holding values > value'''
+    if var._sorted:
+        return -1 << bisect.bisect_right(var.dom, value)
+    m = 0
+    for i, val in enumerate(var.dom):
+        if val > value:
+            m |= 1 << i
+    return m
+
+def _mask_below(var, value):
+    '''Mask of the domain positions of var holding values < value'''
+    if var._sorted:
+        return (1 << bisect.bisect_left(var.dom, value)) - 1
+    m = 0
+    for i, val in enumerate(var.dom):
+        if val < value:
+            m |= 1 << i
+    return m
+
 class Variable: 
 
     '''Class for defining CSP variables.  On initialization the
@@ -45,8 +108,10 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask
+           (bit i for dom[i]) determining which domain values are
+           "current", i.e., unpruned. A value->index map makes membership
+           tests O(1) and sizes are computed by popcount.
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -81,16 +146,31 @@ class Variable:
         '''
         self.name = name                #text name for variable
         self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        #value --> position in self.dom (first occurrence wins, as with
+        #list.index)
+        self.dom_index = dict()
+        for i, val in enumerate(self.dom):
+            self.dom_index.setdefault(val, i)
+        #current domain is an integer bitmask, bit i set iff self.dom[i]
+        #is still in the current domain
+        self.curdom = (1 << len(self.dom)) - 1
+        self._sorted = _is_sorted(self.dom)
+        self._bounds = (None, None, None)   #(mask, min, max) cache
         #for bt_search
         self.assignedValue = None
+        #undo log of the solver currently searching over this variable
+        #(None when not inside a search)
+        self.trail = None
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            self.dom_index.setdefault(val, len(self.dom))
+            self.curdom |= 1 << len(self.dom)
             self.dom.append(val)
-            self.curdom.append(True)
+        self._sorted = _is_sorted(self.dom)
+        self._bounds = (None, None, None)
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -105,47 +185,98 @@ class Variable:
     #
 
     def prune_value(self, value):
-        '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        '''Remove value from CURRENT domain. If the variable is being
+           searched over the change is recorded on the solver's trail
+           so it is undone on backtrack. Pruning a value that is
+           already pruned does nothing.'''
+        bit = 1 << self.dom_index[value]
+        if self.curdom & bit:
+            if self.trail is not None:
+                self.trail.record_pruning(self, self.curdom)
+            self.curdom ^= bit
+
+    def restrict_domain(self, mask):
+        '''Keep only the CURRENT domain values whose bits are set in
+           mask, recording one trail entry however many values go.
+           Returns the new current domain mask.'''
+        new = self.curdom & mask
+        if new != self.curdom:
+            if self.trail is not None:
+                self.trail.record_pruning(self, self.curdom,
+                                          _popcount(self.curdom ^ new))
+            self.curdom = new
+        return new
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        self.curdom |= 1 << self.dom_index[value]
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
         if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
-        return vals
+            return [self.get_assigned_value()]
+        return list(self.cur_domain_iter())
+
+    def cur_domain_iter(self):
+        '''iterate over the values in CURRENT domain without building
+           a list. The domain is read once when iteration starts, so
+           values may be pruned while iterating'''
+        if self.is_assigned():
+            yield self.assignedValue
+            return
+        dom = self.dom
+        m = self.curdom
+        while m:
+            low = m & -m
+            yield dom[low.bit_length() - 1]
+            m ^= low
+
+    def cur_mask(self):
+        '''return the CURRENT domain as a bitmask over domain
+           positions (if assigned only the assigned value's bit is set)'''
+        if self.is_assigned():
+            return 1 << self.dom_index[self.assignedValue]
+        return self.curdom
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.dom_index.get(value)
+        if i is None:
             return False
         if self.is_assigned():
             return value == self.get_assigned_value()
         else:
-            return self.curdom[self.value_index(value)]
+            return (self.curdom >> i) & 1 == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
         if self.is_assigned():
             return 1
         else:
-            return(sum(1 for v in self.curdom if v))
+            return _popcount(self.curdom)
+
+    def cur_domain_min(self):
+        '''Return the smallest value in CURRENT domain (None if empty)'''
+        if self.is_assigned():
+            return self.assignedValue
+        return self._cur_bounds()[1]
+
+    def cur_domain_max(self):
+        '''Return the largest value in CURRENT domain (None if empty)'''
+        if self.is_assigned():
+            return self.assignedValue
+        return self._cur_bounds()[2]
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = (1 << len(self.dom)) - 1
+
+    def restore_state(self, mask):
+        '''Used by Trail. Put back a saved CURRENT domain bitmask'''
+        self.curdom = mask
 
     #
     #methods for assigning and unassigning
@@ -184,7 +315,24 @@ class Variable:
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.dom_index[value]
+
+    def _cur_bounds(self):
+        '''Return (mask, min, max) of the current domain, recomputing
+           only if the domain changed since the last call'''
+        m = self.curdom
+        b = self._bounds
+        if b[0] != m:
+            if not m:
+                b = (m, None, None)
+            elif self._sorted:
+                b = (m, self.dom[(m & -m).bit_length() - 1],
+                        self.dom[m.bit_length() - 1])
+            else:
+                vals = list(self.cur_domain_iter())
+                b = (m, min(vals), max(vals))
+            self._bounds = b
+        return b
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -196,13 +344,22 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [bool((self.curdom >> i) & 1)
+                                                              for i in range(len(self.dom))]))
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
        the satisfied function which tests if an assignment to the
        variables in the constraint's scope satisfies the constraint'''
 
+    #set to False to make has_support scan from the first tuple every
+    #time (e.g. to measure the tuple checks residues save)
+    use_residues = True
+
+    #domain events of its scope variables that make the constraint need
+    #propagating again (see propagators.PropagationEngine)
+    events = REMOVED
+
     def __init__(self, name, scope): 
         '''create a constraint object, specify the constraint name (a
         string) and its scope (an ORDERED list of variable objects).
@@ -226,22 +383,106 @@ class Constraint:
         #The next object data item 'sup_tuples' will be used to help
         #support GAC propgation. It allows access to a list of 
         #satisfying tuples that contain a particular variable/value
-        #pair.
+        #pair. It is built lazily (see index_supports): only the first
+        #nIndexed tuples of sat_tuples are in it.
         self.sup_tuples = dict()
+        self.nIndexed = 0
 
-    def add_satisfying_tuples(self, tuples):
-        '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
+        #shared Relation behind sat_tuples/sup_tuples (see set_relation)
+        self.relation = None
+        self.positions = None
+
+        #residual supports (AC-3.1/AC-2001 style): (var,val) --> index
+        #in sup_tuples[(var,val)] of the last support found. It is
+        #checked first and the scan resumes from there, wrapping round.
+        #Residues need no restoring on backtrack.
+        self.residues = dict()
+
+        #revision counters (see CSP.support_stats)
+        self.nSupportCalls = 0  #calls to has_support
+        self.nTupleChecks = 0   #tuples tested by has_support
+        self.nResidueHits = 0   #calls answered by the residue alone
 
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+        #conflict weight for dom/wdeg variable ordering, incremented
+        #each time propagating this constraint fails (CSP.constraint_failed)
+        self.weight = 1
+
+    #number of tuples add_satisfying_tuples takes from its input at a time
+    chunk_size = 4096
+
+    def add_satisfying_tuples(self, tuples):
+        '''We specify the constraint by adding its complete list of satisfying tuples.
+           tuples may be any iterable (e.g. a generator); it is consumed
+           chunk_size tuples at a time, so it is never held in memory as
+           a whole. The supports of the new tuples are only indexed when
+           has_support next needs them (see index_supports).'''
+        if self.relation is not None:
+            self._unshare()
+        sat = self.sat_tuples
+        it = map(tuple, tuples)   #ensure we have immutable tuples
+        while True:
+            chunk = list(itertools.islice(it, self.chunk_size))
+            if not chunk:
+                break
+            sat.update(zip(chunk, itertools.repeat(True)))
+
+    def index_supports(self):
+        '''Put the tuples added since the last call in sup_tuples as a
+           support for all of the variable values in them'''
+        sat = self.sat_tuples
+        if self.nIndexed == len(sat):
+            return
+        sup = self.sup_tuples
+        scope = self.scope
+        for t in itertools.islice(sat, self.nIndexed, None):
+            for var, val in zip(scope, t):
+                tuples = sup.get((var, val))
+                if tuples is None:
+                    sup[(var, val)] = [t]
+                else:
+                    tuples.append(t)
+        self.nIndexed = len(sat)
+
+    def set_relation(self, relation, positions=None):
+        '''Make the constraint's satisfying tuples those of relation (a
+           Relation), replacing any it had. Scope position i is column
+           positions[i] of the relation (default: the same column), so
+           e.g. x > y can use the relation of '<' with positions (1, 0).
+           sat_tuples and the sup_tuples lists are then shared with
+           every other constraint using the same relation and positions,
+           until tuples are added to this one.'''
+        if positions is None:
+            positions = range(len(self.scope))
+        positions = tuple(positions)
+        if len(positions) != len(self.scope):
+            print("Trying to set relation of arity", len(positions),
+                  "on constraint", self)
+            return
+        sat, by_pos = relation.view(positions)
+        self.relation = relation
+        self.positions = positions
+        self.sat_tuples = sat
+        self.sup_tuples = dict()
+        self.residues = dict()
+        if len(set(self.scope)) < len(self.scope):
+            #a variable twice in the scope: its supports need merging
+            self._unshare()
+            self.sat_tuples = dict()
+            self.nIndexed = 0
+            self.add_satisfying_tuples(sat)
+            return
+        for var, index in zip(self.scope, by_pos):
+            for val, tuples in index.items():
+                self.sup_tuples[(var, val)] = tuples
+        self.nIndexed = len(sat)
+
+    def _unshare(self):
+        '''Take private copies of the shared relation's tuples'''
+        self.sat_tuples = dict(self.sat_tuples)
+        for key in self.sup_tuples:
+            self.sup_tuples[key] = list(self.sup_tuples[key])
+        self.relation = None
+        self.positions = None
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -278,23 +519,715 @@ class Constraint:
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
+        self.nSupportCalls += 1
+        if self.nIndexed != len(self.sat_tuples):
+            self.index_supports()
+        key = (var, val)
+        tups = self.sup_tuples.get(key)
+        if not tups:
+            return False
+        if not Constraint.use_residues:
+            for i, t in enumerate(tups):
                 if self.tuple_is_valid(t):
+                    self.nTupleChecks += i + 1
                     return True
-        return False
+            self.nTupleChecks += len(tups)
+            return False
+
+        n = len(tups)
+        start = self.residues.get(key, 0)
+        i = start
+        while True:
+            if self.tuple_is_valid(tups[i]):
+                if i == start:
+                    self.nResidueHits += 1
+                    self.nTupleChecks += 1
+                else:
+                    self.residues[key] = i
+                    self.nTupleChecks += (i - start) % n + 1
+                return True
+            i += 1
+            if i == n:
+                i = 0
+            if i == start:
+                self.nTupleChecks += n
+                return False
 
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
-        for i, var in enumerate(self.scope):
-            if not var.in_cur_domain(t[i]):
+        for var, val in zip(self.scope, t):
+            if not var.in_cur_domain(val):
                 return False
         return True
 
+    def clear_support_stats(self):
+        '''Reset the has_support revision counters'''
+        self.nSupportCalls = 0
+        self.nTupleChecks = 0
+        self.nResidueHits = 0
+
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class Relation:
+    '''A set of tuples that can back any number of table constraints
+       (flyweight). Build it once, e.g. the not-equal pairs of a
+       futoshiki model, and give it to each constraint with
+       Constraint.set_relation instead of adding the same tuples to
+       every one: memory then grows with the number of distinct
+       relations, not the number of constraints.'''
+
+    def __init__(self, tuples, name=None):
+        self.name = name
+        self.tuples = dict()
+        for x in tuples:
+            self.tuples[tuple(x)] = True
+        self.views = dict()     #positions --> (sat dict, by_pos)
+
+    def __len__(self):
+        return len(self.tuples)
+
+    def view(self, positions):
+        '''Return (dict of the tuples with their columns reordered as
+           positions, [dict value --> reordered tuples with that value
+           at i, for each i]), built once per positions'''
+        positions = tuple(positions)
+        view = self.views.get(positions)
+        if view is None:
+            if positions == tuple(range(len(positions))):
+                sat = self.tuples
+            else:
+                sat = dict()
+                for t in self.tuples:
+                    sat[tuple(t[p] for p in positions)] = True
+            by_pos = [dict() for p in positions]
+            for t in sat:
+                for i, val in enumerate(t):
+                    tuples = by_pos[i].get(val)
+                    if tuples is None:
+                        by_pos[i][val] = [t]
+                    else:
+                        tuples.append(t)
+            view = (sat, by_pos)
+            self.views[positions] = view
+        return view
+
+class PredicateConstraint(Constraint):
+    '''Constraint given by a function instead of a table (intensional
+       constraint). predicate(vals) must return True iff the list of
+       values vals, ordered as the scope, satisfies the constraint.
+
+       Supports are searched for lazily over the current domains of
+       the other variables, so building the constraint costs nothing.
+       The last support found for each (var, val) is kept in a cache
+       of at most cache_size entries (least recently used dropped
+       first) and is tried first by the next has_support call.'''
+
+    def __init__(self, name, scope, predicate, cache_size=10000):
+        '''predicate == function taking a list of values for scope
+           cache_size == max number of (var, val) supports remembered
+           (0 to not cache)'''
+        Constraint.__init__(self, name, scope)
+        self.predicate = predicate
+        self.cache_size = cache_size
+        self.support_cache = OrderedDict()
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported, the predicate defines the constraint'''
+        print("Trying to add satisfying tuples to predicate constraint ", self)
+
+    def check(self, vals):
+        '''Return true iff the values (ordered as the scope) satisfy
+           the predicate'''
+        return bool(self.predicate(list(vals)))
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple (a set
+           of assignments satisfying the predicate where each value is
+           still in the corresponding variables current domain). The
+           tuples are generated one at a time from the current domains.
+        '''
+        self.nSupportCalls += 1
+        key = (var, val)
+        cache = self.support_cache
+        t = cache.get(key)
+        if t is not None:
+            self.nTupleChecks += 1
+            if self.tuple_is_valid(t):
+                self.nResidueHits += 1
+                cache.move_to_end(key)
+                return True
+
+        doms = []
+        for v in self.scope:
+            if v is var:
+                if not var.in_cur_domain(val):
+                    return False
+                doms.append((val,))
+            else:
+                doms.append(list(v.cur_domain_iter()))
+        for t in itertools.product(*doms):
+            self.nTupleChecks += 1
+            if self.predicate(list(t)):
+                if self.cache_size > 0:
+                    cache[key] = t
+                    cache.move_to_end(key)
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+                return True
+        return False
+
+class AllDiffConstraint(Constraint):
+    '''All-different constraint over the scope, made GAC with Regin's
+       algorithm: a value is supported iff its edge belongs to some
+       maximum matching of the variable/value graph, which is the case
+       if it is in the matching, joins two nodes of the same strongly
+       connected component, or lies on an alternating path from a free
+       value.
+
+       The supported values of every variable are computed at once and
+       cached with the domains they were computed for. The cache stays
+       valid while the only changes are removals of unsupported values
+       (which is what GAC prunes), so has_support is usually a few mask
+       tests. When it must be recomputed the previous matching is kept
+       and only repaired.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.position = dict()
+        for pos, var in enumerate(self.scope):
+            self.position.setdefault(var, pos)
+        #value ids: all values of the scope domains
+        self.values = []
+        self.value_id = dict()
+        for var in self.scope:
+            for val in var.dom:
+                if val not in self.value_id:
+                    self.value_id[val] = len(self.values)
+                    self.values.append(val)
+        self.match = [None] * len(self.scope)   #pos --> value id
+        self.cache = None   #(domain masks, supported masks or None)
+        self.nMatchings = 0 #number of times supports were recomputed
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported, the constraint is defined by its scope'''
+        print("Trying to add satisfying tuples to all-different constraint ", self)
+
+    def check(self, vals):
+        '''Return true iff the values are pairwise different'''
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple, i.e.,
+           an assignment of different current domain values to the
+           other variables'''
+        self.nSupportCalls += 1
+        sup = self.supported_masks()
+        if sup is None:
+            return False
+        i = var.dom_index.get(val)
+        if i is None:
+            return False
+        return (sup[self.position[var]] >> i) & 1 == 1
+
+    def supported_masks(self):
+        '''Return, for each scope position, the bitmask of the values
+           with a support (None if the variables cannot all be given
+           different values)'''
+        masks = [var.cur_mask() for var in self.scope]
+        if self.cache is not None:
+            old, sup = self.cache
+            for pos, m in enumerate(masks):
+                if m & ~old[pos]:
+                    break           #domain grew (backtrack)
+                if sup is not None and (old[pos] & ~m) & sup[pos]:
+                    break           #lost a supported value
+            else:
+                self.nResidueHits += 1
+                return sup
+        sup = self._compute_supports(masks)
+        self.cache = (masks, sup)
+        return sup
+
+    def filter_masks(self, masks):
+        '''Return, for each scope position, the bitmask of the values of
+           masks[pos] with a support when the domains are the given masks
+           (None if the variables cannot all be given different values).
+           Does not look at or change the current domains, so solvers
+           keeping their own domains (csp_compiled) can use it.'''
+        return self._compute_supports(masks)
+
+    def _compute_supports(self, masks):
+        '''Regin's filtering for the given domain masks'''
+        self.nMatchings += 1
+        scope = self.scope
+        n = len(scope)
+        nvals = len(self.values)
+        value_id = self.value_id
+
+        #adjacency: pos --> value ids in its current domain
+        adj = []
+        for pos, var in enumerate(scope):
+            ids = []
+            m = masks[pos]
+            while m:
+                low = m & -m
+                ids.append(value_id[var.dom[low.bit_length() - 1]])
+                m ^= low
+            adj.append(ids)
+
+        #repair the previous matching: keep pairs still in the domains
+        match = self.match
+        owner = [None] * nvals          #value id --> pos
+        for pos in range(n):
+            v = match[pos]
+            if v is not None and v in adj[pos] and owner[v] is None:
+                owner[v] = pos
+            else:
+                match[pos] = None
+        for pos in range(n):
+            if match[pos] is None and not self._augment(pos, adj, match, owner):
+                return None
+
+        #directed graph: matched edges pos --> value, the others
+        #value --> pos (vvars[v] == the positions v points to).
+        vvars = [[] for v in range(nvals)]
+        for pos in range(n):
+            for v in adj[pos]:
+                if v != match[pos]:
+                    vvars[v].append(pos)
+
+        #values reachable from a free value support all their edges
+        reach = [False] * nvals
+        stack = [v for v in range(nvals) if owner[v] is None]
+        for v in stack:
+            reach[v] = True
+        while stack:
+            v = stack.pop()
+            for pos in vvars[v]:
+                w = match[pos]
+                if not reach[w]:
+                    reach[w] = True
+                    stack.append(w)
+
+        comp = self._scc(n, nvals, vvars, match)
+
+        sup = []
+        for pos, var in enumerate(scope):
+            s = 0
+            m = masks[pos]
+            while m:
+                low = m & -m
+                v = value_id[var.dom[low.bit_length() - 1]]
+                if v == match[pos] or reach[v] or comp[pos] == comp[n + v]:
+                    s |= low
+                m ^= low
+            sup.append(s)
+        return sup
+
+    def _augment(self, root, adj, match, owner):
+        '''Find an augmenting path from the free variable root (BFS over
+           alternating paths) and flip it. False if there is none.'''
+        parent = {root: None}           #pos --> (previous pos, value)
+        frontier = [root]
+        while frontier:
+            nxt = []
+            for pos in frontier:
+                for v in adj[pos]:
+                    p = owner[v]
+                    if p is None:
+                        #free value: flip the path back to root
+                        while pos is not None:
+                            prev = parent[pos]
+                            owner[v] = pos
+                            old = match[pos]
+                            match[pos] = v
+                            v = old
+                            pos = prev
+                        return True
+                    if p not in parent:
+                        parent[p] = pos
+                        nxt.append(p)
+            frontier = nxt
+        return False
+
+    def _scc(self, n, nvals, vvars, match):
+        '''Strongly connected components (iterative Tarjan) of the
+           matching graph. Node ids: pos for variables, n + v for
+           values. Returns list node --> component number.'''
+        size = n + nvals
+        #successors: pos --> its matched value, value --> positions that
+        #have it in their domain but are not matched to it
+        succ = [[n + match[pos]] for pos in range(n)] + vvars
+
+        index = [None] * size
+        low = [0] * size
+        comp = [None] * size
+        onstack = [False] * size
+        sstack = []
+        counter = 0
+        ncomp = 0
+        for start in range(size):
+            if index[start] is not None:
+                continue
+            work = [(start, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = counter
+                    counter += 1
+                    sstack.append(node)
+                    onstack[node] = True
+                recurse = False
+                edges = succ[node]
+                while i < len(edges):
+                    w = edges[i]
+                    i += 1
+                    if index[w] is None:
+                        work.append((node, i))
+                        work.append((w, 0))
+                        recurse = True
+                        break
+                    elif onstack[w] and index[w] < low[node]:
+                        low[node] = index[w]
+                if recurse:
+                    continue
+                if low[node] == index[node]:
+                    while True:
+                        w = sstack.pop()
+                        onstack[w] = False
+                        comp[w] = ncomp
+                        if w == node:
+                            break
+                    ncomp += 1
+                if work:
+                    parent = work[-1][0]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+        return comp
+
+class InequalityConstraint(Constraint):
+    '''Chain of strict inequalities between consecutive variables of
+       the scope: ops[i] ('<' or '>') relates scope[i] to scope[i+1],
+       so InequalityConstraint(name, (a, b, c), '<>') is a < b > c and
+       a plain binary a < b has ops '<'.
+
+       Only the bounds of the domains matter: a < b removes the values
+       of b not above min(a) and the values of a not below max(b), a
+       couple of mask operations per variable instead of a support
+       search per value. A forward pass along the chain pushes each
+       variable's bounds onto the next and a backward pass pushes them
+       back; a chain is a tree, so the two passes leave every value
+       that is left with a support. The result is cached with the
+       domains it was computed for, so has_support is a mask test and
+       the PropagationEngine (see propagate) only wakes the constraint
+       when a bound changes.'''
+
+    events = BOUNDS
+
+    def __init__(self, name, scope, ops='<'):
+        Constraint.__init__(self, name, scope)
+        if len(ops) != len(self.scope) - 1 or set(ops) - set('<>'):
+            raise ValueError("need one of '<', '>' per consecutive pair "
+                             "of the scope, got {!r}".format(ops))
+        self.ops = ops
+        self.position = dict()
+        for pos, var in enumerate(self.scope):
+            self.position.setdefault(var, pos)
+        self.cache = None   #(domain masks, supported masks or None)
+
+    def add_satisfying_tuples(self, tuples):
+        '''Not supported, the constraint is defined by ops'''
+        print("Trying to add satisfying tuples to inequality constraint ", self)
+
+    def check(self, vals):
+        '''Return true iff every consecutive pair of values satisfies
+           its inequality'''
+        for i, op in enumerate(self.ops):
+            if op == '<':
+                if not vals[i] < vals[i+1]:
+                    return False
+            elif not vals[i] > vals[i+1]:
+                return False
+        return True
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple, i.e.,
+           current domain values of the rest of the chain satisfying
+           every inequality'''
+        self.nSupportCalls += 1
+        sup = self.supported_masks()
+        if sup is None:
+            return False
+        i = var.dom_index.get(val)
+        if i is None:
+            return False
+        return (sup[self.position[var]] >> i) & 1 == 1
+
+    def supported_masks(self):
+        '''Return, for each scope position, the bitmask of the values
+           with a support (None if the chain cannot be satisfied)'''
+        masks = [var.cur_mask() for var in self.scope]
+        if self.cache is not None and self.cache[0] == masks:
+            self.nResidueHits += 1
+            return self.cache[1]
+        sup = self.filter_masks(masks)
+        self.cache = (masks, sup)
+        return sup
+
+    def propagate(self, delta=None):
+        '''Used by propagators.PropagationEngine: prune every variable
+           of the chain to its supported values. Returns False if the
+           chain cannot be satisfied.'''
+        sup = self.supported_masks()
+        if sup is None:
+            return False
+        for var, m in zip(self.scope, sup):
+            if not var.is_assigned():
+                var.restrict_domain(m)
+        self.cache = (list(sup), sup)
+        return True
+
+    def filter_masks(self, masks):
+        '''Return, for each scope position, the bitmask of the values of
+           masks[pos] with a support when the domains are the given masks
+           (None if the chain cannot be satisfied). Does not look at or
+           change the current domains.'''
+        scope = self.scope
+        ops = self.ops
+        masks = list(masks)
+        #forward: bounds of scope[i] onto scope[i+1]
+        for i, op in enumerate(ops):
+            if not masks[i]:
+                return None
+            if op == '<':
+                masks[i+1] &= _mask_above(scope[i+1],
+                                          _mask_min(scope[i], masks[i]))
+            else:
+                masks[i+1] &= _mask_below(scope[i+1],
+                                          _mask_max(scope[i], masks[i]))
+        #backward: bounds of scope[i+1] onto scope[i]
+        for i in range(len(ops) - 1, -1, -1):
+            if not masks[i+1]:
+                return None
+            if ops[i] == '<':
+                masks[i] &= _mask_below(scope[i],
+                                        _mask_max(scope[i+1], masks[i+1]))
+            else:
+                masks[i] &= _mask_above(scope[i],
+                                        _mask_min(scope[i+1], masks[i+1]))
+        if not masks[0]:
+            return None
+        return masks
+
+class Trail:
+    '''Undo log used by bt_search. Reversible objects (Variables, and
+       anything else offering a restore_state(state) method) call
+       record() with their old state just before they change it. The
+       solver pushes a level marker before each decision and pops back
+       to it on backtrack, so restoring costs only the number of
+       changes actually undone.'''
+
+    def __init__(self):
+        self.objs = []      #objects changed, oldest first
+        self.states = []    #state of objs[i] before the change
+        self.marks = []     #len(objs) at the start of each level
+        self.nPrunings = 0  #number of variable values pruned
+
+    def record(self, obj, state):
+        '''Save state of obj; obj.restore_state(state) on backtrack'''
+        self.objs.append(obj)
+        self.states.append(state)
+
+    def record_pruning(self, var, mask, n=1):
+        '''Called by Variable.prune_value with the old domain mask
+           (n == number of values being pruned)'''
+        self.objs.append(var)
+        self.states.append(mask)
+        self.nPrunings += n
+
+    def size(self):
+        '''Number of changes currently on the trail'''
+        return len(self.objs)
+
+    def level(self):
+        '''Number of open levels'''
+        return len(self.marks)
+
+    def push_level(self):
+        '''Start a new level (e.g. before assigning a variable)'''
+        self.marks.append(len(self.objs))
+
+    def pop_level(self):
+        '''Undo every change made since the matching push_level'''
+        self.undo_to(self.marks.pop())
+
+    def undo_to(self, size):
+        '''Undo changes (newest first) until only size are left'''
+        objs = self.objs
+        states = self.states
+        while len(objs) > size:
+            objs.pop().restore_state(states.pop())
+
+    def clear(self):
+        '''Undo everything and drop all levels'''
+        self.undo_to(0)
+        self.marks = []
+
+class MRVQueue:
+    '''Priority queue of unassigned variables keyed on current domain
+       size (smallest first) for MRV variable selection. Ties are
+       broken by larger degree (number of constraints on the variable,
+       from CSP.vars_to_cons) if degrees are given, and then by the
+       order the variables were given in.
+
+       The heap is updated lazily: update(var) must be called when a
+       member's domain shrinks; growth on backtrack is noticed when the
+       (now too small) entry reaches the top, and it is pushed again
+       with the right size. Entries of variables no longer in the queue
+       are dropped as they surface.'''
+
+    def __init__(self, vars, degree=None):
+        '''vars == variables in tie-break order
+           degree == optional dict Variable --> degree'''
+        self.order = dict()
+        for i, var in enumerate(vars):
+            self.order[var] = i
+        self.degree = degree
+        self.heap = []
+        self.size = dict()     #member --> size of its newest heap entry
+
+    def __len__(self):
+        return len(self.size)
+
+    def __contains__(self, var):
+        return var in self.size
+
+    def _push(self, var, sz):
+        self.size[var] = sz
+        if self.degree is None:
+            heapq.heappush(self.heap, (sz, self.order[var], var))
+        else:
+            heapq.heappush(self.heap, (sz, -self.degree[var],
+                                       self.order[var], var))
+
+    def add(self, var):
+        '''Put var (back) into the queue'''
+        self._push(var, var.cur_domain_size())
+
+    def discard(self, var):
+        '''Take var out of the queue (if it is in it)'''
+        self.size.pop(var, None)
+
+    def update(self, var):
+        '''Note that var's current domain may have changed'''
+        sz = self.size.get(var)
+        if sz is not None and sz != var.cur_domain_size():
+            self._push(var, var.cur_domain_size())
+
+    def pop(self):
+        '''Remove and return the variable with smallest current domain'''
+        if len(self.heap) > 4 * len(self.size) + 64:
+            self._rebuild()
+        heap = self.heap
+        size = self.size
+        while heap:
+            entry = heapq.heappop(heap)
+            var = entry[-1]
+            sz = size.get(var)
+            if sz is None or sz != entry[0]:
+                continue            #var popped already, or newer entry
+            cur = var.cur_domain_size()
+            if cur != sz:
+                self._push(var, cur)  #domain restored since the entry
+                continue
+            del size[var]
+            return var
+        return None
+
+    def _rebuild(self):
+        '''Drop stale entries'''
+        members = list(self.size)
+        self.heap = []
+        self.size = dict()
+        for var in members:
+            self.add(var)
+
+def luby(i):
+    '''i-th term (i >= 1) of the Luby sequence 1,1,2,1,1,2,4,1,1,2,...'''
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while i != (1 << k) - 1:
+        i -= (1 << (k-1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k-1)
+
+def restart_cutoffs(schedule, base, factor=1.5):
+    '''Generator of failure cutoffs for successive runs of a restarting
+       search. schedule == 'luby' (base * luby(i)) or 'geometric'
+       (base * factor**i)'''
+    i = 0
+    while True:
+        i += 1
+        if schedule == 'luby':
+            yield base * luby(i)
+        elif schedule == 'geometric':
+            yield int(base * factor ** (i-1))
+        else:
+            raise ValueError("unknown restart schedule {}".format(schedule))
+
+class NogoodStore:
+    '''Nogoods learned by BT at restarts. A nogood is a tuple of
+       (var, val) pairs that cannot all hold in any solution. When all
+       but one of them hold (the last var still unassigned), the last
+       var's value is pruned; if all of them hold the assignment fails.
+       Prunings go through prune_value, so they are undone on backtrack
+       like any other.'''
+
+    def __init__(self):
+        self.nogoods = []
+        self.watch = dict()     #var --> nogoods with var in them
+
+    def __len__(self):
+        return len(self.nogoods)
+
+    def add(self, nogood):
+        nogood = tuple(nogood)
+        self.nogoods.append(nogood)
+        for var, val in nogood:
+            self.watch.setdefault(var, []).append(nogood)
+
+    def propagate(self, var=None):
+        '''Check the nogoods with var in them (all nogoods if var is
+           None). Returns False if one is violated or a domain is wiped
+           out.'''
+        nogoods = self.nogoods if var is None else self.watch.get(var, ())
+        for nogood in nogoods:
+            free = None
+            for v, val in nogood:
+                if v.is_assigned():
+                    if v.get_assigned_value() != val:
+                        break
+                elif not v.in_cur_domain(val):
+                    break
+                elif free is None:
+                    free = v
+                else:
+                    break       #two literals undecided
+            else:
+                if free is None:
+                    return False
+                for v, val in nogood:
+                    if v is free:
+                        v.prune_value(val)
+                        if v.cur_domain_size() == 0:
+                            return False
+        return True
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -309,6 +1242,7 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        self.failed_constraint = None   #see constraint_failed
         for v in vars:
             self.add_var(v)
 
@@ -326,7 +1260,7 @@ class CSP:
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
@@ -348,6 +1282,34 @@ class CSP:
         '''return list of variables in the CSP'''
         return list(self.vars)
 
+    def support_stats(self):
+        '''return dict with the has_support revision counters summed
+           over all constraints'''
+        stats = {'support_calls': 0, 'tuple_checks': 0, 'residue_hits': 0}
+        for c in self.cons:
+            stats['support_calls'] += c.nSupportCalls
+            stats['tuple_checks'] += c.nTupleChecks
+            stats['residue_hits'] += c.nResidueHits
+        return stats
+
+    def clear_support_stats(self):
+        '''Reset the has_support revision counters of all constraints'''
+        for c in self.cons:
+            c.clear_support_stats()
+
+    def constraint_failed(self, c):
+        '''Called by a propagator when propagating constraint c wiped
+           out a domain (or c was violated): bumps c's conflict weight
+           and remembers c as the last failure'''
+        c.weight += 1
+        self.failed_constraint = c
+
+    def clear_weights(self):
+        '''Reset the conflict weights of all constraints'''
+        for c in self.cons:
+            c.weight = 1
+        self.failed_constraint = None
+
     def print_all(self):
         print("CSP", self.name)
         print("   Variables = ", self.vars)
@@ -373,16 +1335,55 @@ class BT:
        kind or propagator function to obtain plain backtracking
        forward-checking or gac'''
 
-    def __init__(self, csp):
-        '''csp == CSP object specifying the CSP to be solved'''
+    def __init__(self, csp, degree_tiebreak=False, restarts=None,
+                 restart_base=100, restart_factor=1.5, seed=None,
+                 var_order='mrv', sac=False, sac_time_limit=None):
+        '''csp == CSP object specifying the CSP to be solved
+           degree_tiebreak == break MRV ties in favour of the variable
+           in the most constraints
+           var_order == 'mrv' (smallest current domain first) or
+           'domwdeg' (smallest current domain size / weighted degree,
+           see extract_domwdeg_var)
+           restarts == None (chronological search), 'luby' or
+           'geometric': give up on a run after restart_base * luby(i)
+           (or restart_base * restart_factor**i) failed propagations in
+           it and start again from the root. Nogoods recorded at each
+           restart keep later runs out of the subtrees already refuted.
+           Restarts stop once a solution has been found.
+           seed == if not None, break MRV ties and order values at
+           random (random.Random(seed)), so runs differ
+           sac == make the root singleton arc consistent before the
+           search starts (see singleton_ac), giving up after
+           sac_time_limit seconds if that is not None'''
 
         self.csp = csp
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
+        self.nSolutions = 0 #solutions found by bt_solutions/bt_count
         unasgn_vars = list() #used to track unassigned variables
+        self.trail = Trail() #undo log for prunings made during search
         self.TRACE = False
         self.runtime = 0
+        self.degree_tiebreak = degree_tiebreak
+        self.stack = []             #choice points of bt_iterate
+        self.node_callback = None   #see bt_iterate
+        self.restarts = restarts
+        self.restart_base = restart_base
+        self.restart_factor = restart_factor
+        self.seed = seed
+        self.rng = None
+        self.nogoods = NogoodStore()
+        self.nFailures = 0  #failed propagations during search
+        self.nRestarts = 0
+        if var_order not in ('mrv', 'domwdeg'):
+            raise ValueError("unknown variable ordering {}".format(var_order))
+        self.var_order = var_order
+        self.heuristicTime = 0  #seconds spent choosing variables
+        self.sac = sac
+        self.sac_time_limit = sac_time_limit
+        self.nSACPrunings = 0   #values removed by singleton_ac
+        self.sacTime = 0        #seconds spent in singleton_ac
 
     def trace_on(self):
         '''Turn search trace on'''
@@ -397,11 +1398,27 @@ class BT:
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nSolutions = 0
+        self.nFailures = 0
+        self.nRestarts = 0
+        self.heuristicTime = 0
+        self.nSACPrunings = 0
+        self.sacTime = 0
         self.runtime = 0
 
     def print_stats(self):
         print("Search made {} variable assignments and pruned {} variable values".format(
             self.nDecisions, self.nPrunings))
+        if self.sac:
+            print("SAC removed {} values in {:.3f} seconds".format(
+                self.nSACPrunings, self.sacTime))
+        if self.var_order == 'domwdeg':
+            print("dom/wdeg took {:.3f} seconds ({:.1f} microseconds per decision)".format(
+                self.heuristicTime, 1e6 * self.heuristic_time_per_node()))
+
+    def heuristic_time_per_node(self):
+        '''Average seconds spent choosing the variable per decision'''
+        return self.heuristicTime / max(1, self.nDecisions)
 
     def restoreValues(self,prunings):
         '''Restore list of values to variable domains
@@ -409,6 +1426,20 @@ class BT:
         for var, val in prunings:
             var.unprune_value(val)
 
+    def attach_trail(self):
+        '''Start recording the prunings of every CSP variable on a
+           fresh trail'''
+        self.trail = Trail()
+        for var in self.csp.vars:
+            var.trail = self.trail
+
+    def detach_trail(self):
+        '''Undo everything recorded on the trail and stop recording.
+           Assignments are left alone so a solution stays visible.'''
+        self.trail.clear()
+        for var in self.csp.vars:
+            var.trail = None
+
     def restore_all_variable_domains(self):
         '''Reinitialize all variable domains'''
         for var in self.csp.vars:
@@ -416,27 +1447,116 @@ class BT:
                 var.unassign()
             var.restore_curdom()
 
+    def init_unasgn_vars(self):
+        '''Put every unassigned variable of the CSP in the MRV queue'''
+        degree = None
+        if self.degree_tiebreak:
+            degree = dict()
+            for v in self.csp.vars:
+                degree[v] = len(self.csp.vars_to_cons[v])
+        order = self.csp.vars
+        if self.rng is not None:
+            order = list(order)
+            self.rng.shuffle(order)
+        self.unasgn_vars = MRVQueue(order, degree)
+        for v in self.csp.vars:
+            if not v.is_assigned():
+                self.unasgn_vars.add(v)
+
+    def update_unasgn_vars(self, start):
+        '''Tell the MRV queue about the variables pruned since trail
+           position start'''
+        if self.var_order != 'mrv':
+            return      #queue only used as the set of unassigned vars
+        objs = self.trail.objs
+        for i in range(start, len(objs)):
+            self.unasgn_vars.update(objs[i])
+
     def extractMRVvar(self):
-        '''Remove variable with minimum sized cur domain from list of
-           unassigned vars. Would be faster to use heap...but this is
-           not production code.
+        '''Remove variable with minimum sized cur domain from the
+           queue of unassigned vars (or the dom/wdeg choice, see
+           var_order).
         '''
-
-        md = -1
-        mv = None
-        for v in self.unasgn_vars:
-            if md < 0:
-                md = v.cur_domain_size()
-                mv = v
-            elif v.cur_domain_size() < md:
-                md = v.cur_domain_size()
-                mv = v
-        self.unasgn_vars.remove(mv)
-        return mv
+        t0 = time.perf_counter()
+        if self.var_order == 'domwdeg':
+            var = self.extract_domwdeg_var()
+        else:
+            var = self.unasgn_vars.pop()
+        self.heuristicTime += time.perf_counter() - t0
+        return var
+
+    def extract_domwdeg_var(self):
+        '''Remove and return the unassigned variable with the smallest
+           cur_domain_size / wdeg, where wdeg is the sum of the weights
+           of its constraints (CSP.vars_to_cons) that still have another
+           unassigned variable. Ties go to the earlier variable.'''
+        queue = self.unasgn_vars
+        vars_to_cons = self.csp.vars_to_cons
+        order = queue.order
+        best = None
+        best_key = None
+        for var in queue.size:
+            wdeg = 0
+            for c in vars_to_cons[var]:
+                if c.get_n_unasgn() > 1:
+                    wdeg += c.weight
+            sz = var.cur_domain_size()
+            key = (sz / wdeg if wdeg else float('inf'), sz, order[var])
+            if best_key is None or key < best_key:
+                best = var
+                best_key = key
+        if best is not None:
+            queue.discard(best)
+            if len(queue.heap) > 4 * len(queue) + 64:
+                queue._rebuild()
+        return best
 
     def restoreUnasgnVar(self, var):
         '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
+        self.unasgn_vars.add(var)
+
+    def choice_point(self, var):
+        '''New bt_iterate stack frame for var: [var, values to try,
+           index of next value]'''
+        vals = var.cur_domain()
+        if self.rng is not None:
+            self.rng.shuffle(vals)
+        return [var, vals, 0]
+
+    def record_nogoods(self):
+        '''Add the nogoods proved by the choice points on self.stack:
+           each value already tried and refuted at a choice point,
+           together with the values currently assigned at the choice
+           points below it. The top choice point's current value is
+           taken as refuted too (called after it failed).'''
+        prefix = []
+        stack = self.stack
+        for k, (var, vals, nxt) in enumerate(stack):
+            tried = nxt if k == len(stack) - 1 else nxt - 1
+            for val in vals[:tried]:
+                self.nogoods.add(prefix + [(var, val)])
+            if var.is_assigned():
+                prefix.append((var, var.get_assigned_value()))
+
+    def restart(self, propagator, root_size, root_levels):
+        '''Record nogoods, undo the current run back to the root (trail
+           size root_size with root_levels levels open) and propagate
+           the nogoods there. Returns False if that shows there is no
+           solution.'''
+        trail = self.trail
+        self.record_nogoods()
+        for frame in self.stack:
+            if frame[0].is_assigned():
+                frame[0].unassign()
+        trail.undo_to(root_size)
+        del trail.marks[root_levels:]
+        self.stack = []
+        self.nRestarts += 1
+        status = self.nogoods.propagate()
+        if status:
+            status, prunings = propagator(self.csp)
+        self.init_unasgn_vars()
+        return status
         
     def bt_search(self,propagator):
         '''Try to solve the CSP using specified propagator routine
@@ -462,39 +1582,28 @@ class BT:
              in this case bt_search will backtrack
            return is true if we can continue.
 
-           The list of variable values pairs are all of the values
-           the propagator pruned (using the variable's prune_value method). 
-           bt_search NEEDS to know this in order to correctly restore these 
-           values when it undoes a variable assignment.
+           Values must be pruned with the variable's prune_value
+           method. While bt_search runs every variable of the CSP
+           records its prunings on the solver's trail, so bt_search
+           restores them itself when it undoes a variable assignment.
+           The returned list is therefore ignored (the propagators in
+           propagators.py return an empty list) and pruning a value that
+           is already pruned is harmless.
 
-           NOTE propagator SHOULD NOT prune a value that has already been 
-           pruned! Nor should it prune a value twice'''
+           Returns True if a solution was found (it is left assigned to
+           the variables), False otherwise.'''
 
-        self.clear_stats()
         stime = time.process_time()
-
-        self.restore_all_variable_domains()
-        
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
-
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
-
-        if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
+        status = self.start_search(propagator)
 
         if status == False:
             print("CSP{} detected contradiction at root".format(
                 self.csp.name))
         else:
-            status = self.bt_recurse(propagator, 1)   #now do recursive search
-
+            #now do the search
+            status = next(self.bt_iterate(propagator), False)
 
-        self.restoreValues(prunings)
+        self.finish_search(stime)
         if status == False:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
         if status == True:
@@ -504,46 +1613,277 @@ class BT:
 
         print("bt_search finished")
         self.print_stats()
+        return status
+
+    def start_search(self, propagator):
+        '''Reset statistics and domains, start the trail and run the
+           root propagation. Returns the propagator's status.'''
+        self.clear_stats()
+        self.restore_all_variable_domains()
+        self.attach_trail()
+        self.nogoods = NogoodStore()
+        self.csp.clear_weights()
+        if self.seed is not None:
+            self.rng = random.Random(self.seed)
 
-    def bt_recurse(self, propagator, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
+        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
+        if status and self.sac:
+            status = self.singleton_ac(propagator, self.sac_time_limit)
+        self.init_unasgn_vars()
 
         if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
+            print(len(self.unasgn_vars), " unassigned variables at start of search")
+            print("Root Prunings: ", self.trail.nPrunings)
+        return status
+
+    def singleton_ac(self, propagator, time_limit=None):
+        '''Singleton arc consistency at the root: try each value left in
+           each unassigned variable's domain by assigning it and running
+           propagator (prop_GAC gives SAC proper), prune the values whose
+           propagation fails and propagate the prunings. Repeats until a
+           whole pass removes nothing, or time_limit seconds are up (the
+           values already removed stay removed).
+
+           Call after the root propagation, with the trail attached.
+           Sets nSACPrunings (values removed, including those pruned
+           by propagating the removals) and sacTime, and returns False
+           if some variable is left without values.'''
+        stime = time.perf_counter()
+        deadline = None if time_limit is None else stime + time_limit
+        trail = self.trail
+        csp = self.csp
+        start_prunings = trail.nPrunings
+        status = True
+        changed = True
+        timed_out = False
+        while changed and status and not timed_out:
+            changed = False
+            for var in csp.vars:
+                if var.is_assigned():
+                    continue
+                for val in var.cur_domain():
+                    if deadline is not None and time.perf_counter() > deadline:
+                        timed_out = True
+                        break
+                    if not var.in_cur_domain(val):
+                        continue    #pruned while propagating a removal
+                    #probe val, then undo it and what it pruned (those
+                    #prunings are not counted)
+                    nPrunings = trail.nPrunings
+                    trail.push_level()
+                    var.assign(val)
+                    ok, prunings = propagator(csp, var)
+                    var.unassign()
+                    trail.pop_level()
+                    trail.nPrunings = nPrunings
+                    if ok:
+                        continue
+                    var.prune_value(val)
+                    changed = True
+                    status, prunings = propagator(csp)
+                    if not status or var.cur_domain_size() == 0:
+                        status = False
+                        break
+                if not status or timed_out:
+                    break
+        self.nSACPrunings = trail.nPrunings - start_prunings
+        self.sacTime = time.perf_counter() - stime
+        if self.TRACE:
+            print("SAC removed {} values in {:.3f} seconds".format(
+                self.nSACPrunings, self.sacTime))
+        return status
+
+    def finish_search(self, stime):
+        '''Record statistics and undo all prunings (stime == process
+           time the search started)'''
+        self.nPrunings = self.trail.nPrunings
+        self.runtime = time.process_time() - stime
+        self.detach_trail()
+
+    def push_decisions(self, propagator, decisions):
+        '''Assign each (var, val) of decisions in turn and propagate, as
+           the search would, but without counting them as decisions
+           (e.g. to replay the path to a subproblem). Call after
+           start_search; the assignments are undone by the next
+           start_search. Returns False as soon as a value is not in its
+           variable's current domain or propagation fails.'''
+        trail = self.trail
+        for var, val in decisions:
+            if var.is_assigned() or not var.in_cur_domain(val):
+                return False
+            var.assign(val)
+            self.unasgn_vars.discard(var)
+            mark = trail.size()
+            trail.push_level()
+            status, prunings = propagator(self.csp, var)
+            self.update_unasgn_vars(mark)
+            if not status:
+                return False
+        return True
+
+    def bt_solutions(self, propagator, limit=None):
+        '''Generator over all solutions of the CSP: yields each one as
+           a dict Variable --> value while the search continues. Nothing
+           is printed. limit == stop after this many solutions.
+
+           While a solution is being looked at it is also assigned to
+           the variables. When the generator finishes (or is closed) all
+           variables are unassigned and their domains restored.'''
+        return self._solutions(propagator, limit, True)
+
+    def bt_count(self, propagator, limit=None):
+        '''Return the number of solutions of the CSP (counting stops at
+           limit, so limit=2 checks that a solution is unique) without
+           building solution objects'''
+        n = 0
+        for soln in self._solutions(propagator, limit, False):
+            n += 1
+        return n
+
+    def _solutions(self, propagator, limit, build):
+        stime = time.process_time()
+        try:
+            if not self.start_search(propagator):
+                return
+            if limit is not None and limit <= 0:
+                return
+            vars = self.csp.vars
+            for found in self.bt_iterate(propagator):
+                self.nSolutions += 1
+                if build:
+                    soln = dict()
+                    for var in vars:
+                        soln[var] = var.assignedValue
+                    yield soln
+                else:
+                    yield None
+                if limit is not None and self.nSolutions >= limit:
+                    return
+        finally:
+            self.finish_search(stime)
+            for var in self.csp.vars:
+                if var.is_assigned():
+                    var.unassign()
+
+    def bt_iterate(self, propagator):
+        '''Iterative backtracking search with an explicit stack of
+           choice points, so deep CSPs neither pay for a Python frame
+           per variable nor hit the recursion limit.
+
+           Generator: yields True each time every variable is assigned
+           (the solution can then be read off the variables). Resuming
+           it backtracks from that solution and continues the search.
+           If it finishes the search space has been exhausted.
+
+           The choice points are kept in self.stack. If self.node_callback
+           is set it is called after every successful propagation and
+           may edit the untried values of the choice points (e.g. to
+           give them to another solver; with restarts values removed so
+           must also be added to self.nogoods, as a restart rebuilds the
+           choice points from the root); if it returns True the search
+           is abandoned.
+
+           With self.restarts set, a run is abandoned once it has had
+           its cutoff of failed propagations, nogoods are recorded from
+           self.stack and the search restarts from the root (see
+           restart), until the first solution is found.'''
+
+        trail = self.trail
+        csp = self.csp
+        callback = self.node_callback
+        nogoods = self.nogoods
         if not self.unasgn_vars:
             #all variables assigned
-            return True
-        else:
-            var = self.extractMRVvar()
-            if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
+            yield True
+            return
 
-            for val in var.cur_domain():
+        cutoffs = None
+        if self.restarts is not None:
+            cutoffs = restart_cutoffs(self.restarts, self.restart_base,
+                                      self.restart_factor)
+            cutoff = next(cutoffs)
+            fails = 0
+            root_size = trail.size()
+            root_levels = trail.level()
+
+        var = self.extractMRVvar()
+        #choice point == [var, values to try, index of next value]
+        stack = [self.choice_point(var)]
+        self.stack = stack
+        if self.TRACE:
+            print('  ', "bt_iterate level ", 1)
+            print('  ', "bt_iterate var = ", var)
 
+        while stack:
+            frame = stack[-1]
+            var = frame[0]
+            level = len(stack)
+            if var.is_assigned():
+                #back from trying the previous value of this choice point
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
+                    print('  ' * level, "bt_iterate restoring ",
+                          trail.size() - trail.marks[-1])
+                trail.pop_level()
+                var.unassign()
 
-                var.assign(val)
-                self.nDecisions = self.nDecisions+1
+            vals = frame[1]
+            if frame[2] == len(vals):
+                #all values failed, backtrack
+                stack.pop()
+                self.restoreUnasgnVar(var)
+                continue
+            val = vals[frame[2]]
+            frame[2] += 1
 
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+            if self.TRACE:
+                print('  ' * level, "bt_iterate trying", var, "=", val)
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
 
-                if status:
-                    if self.bt_recurse(propagator, level+1):
-                        return True
+            mark = trail.size()
+            trail.push_level()
+            status = not nogoods.nogoods or nogoods.propagate(var)
+            if status:
+                status, prunings = propagator(csp, var)
+            self.update_unasgn_vars(mark)
 
+            if self.TRACE:
+                print('  ' * level, "bt_iterate prop status = ", status)
+                print('  ' * level, "bt_iterate prop pruned = ",
+                      trail.size() - mark)
+
+            if not status:
+                self.nFailures += 1
+                if cutoffs is None:
+                    continue
+                fails += 1
+                if fails < cutoff:
+                    continue
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
-                var.unassign()
-
-            self.restoreUnasgnVar(var)
-            return False
+                    print("bt_iterate restart after", fails, "failures")
+                if not self.restart(propagator, root_size, root_levels):
+                    return
+                root_size = trail.size()
+                fails = 0
+                cutoff = next(cutoffs)
+                if not self.unasgn_vars:
+                    yield True
+                    return
+                var = self.extractMRVvar()
+                stack = [self.choice_point(var)]
+                self.stack = stack
+                continue
+            if callback is not None and callback():
+                return
+            if not self.unasgn_vars:
+                #all variables assigned
+                cutoffs = None  #no more restarts, keep the solutions' run
+                yield True
+                continue
 
+            var = self.extractMRVvar()
+            stack.append(self.choice_point(var))
+            if self.TRACE:
+                print('  ' * (level+1), "bt_iterate level ", level+1)
+                print('  ' * (level+1), "bt_iterate var = ", var)
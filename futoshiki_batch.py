@@ -0,0 +1,169 @@
+'''Batch solver for futoshiki boards.
+
+Reads boards, one per line of a JSONL file, in the
+initial_futoshiki_board format of futoshiki_csp.py, either as a bare
+list of rows or as an object {"id": ..., "board": [...]}. Each board is
+built with futoshiki_csp_model_<model>, solved with BT on a pool of
+worker processes, and one JSON object per board is written:
+
+    {"index": 0, "id": ..., "solved": true, "solution": [[...], ...],
+     "nDecisions": 16, "nPrunings": 38, "build_time": ..., "solve_time": ...}
+
+("error" instead of the results if the line could not be solved.)
+Nothing is printed to stdout unless it is the output file. At most
+--window boards are read ahead of the output, so memory stays bounded
+however long the input is. --order input writes results in input order,
+--order completion as soon as each board is done.
+
+    python futoshiki_batch.py boards.jsonl -o solutions.jsonl --model 3
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from cspbase import *
+import propagators
+import futoshiki_csp
+import csp_store
+
+def solve_board(board, model=3, propagator='GAC', cache_dir=None):
+    '''Build and solve one board. Returns a dict with solved, solution
+       (list of rows of values, None if unsolvable), nDecisions,
+       nPrunings, build_time and solve_time (seconds). With cache_dir
+       the model is loaded from/saved to that csp_store cache.'''
+    build = getattr(futoshiki_csp, 'futoshiki_csp_model_{}'.format(model))
+    t0 = time.perf_counter()
+    if cache_dir is None:
+        csp, var_array = build(board)
+    else:
+        csp, var_array = csp_store.cached_model(build, board, cache_dir)
+    build_time = time.perf_counter() - t0
+
+    solver = BT(csp)
+    t0 = time.perf_counter()
+    soln = next(solver.bt_solutions(propagators.PROPAGATORS[propagator],
+                                    limit=1), None)
+    solve_time = time.perf_counter() - t0
+    rows = None
+    if soln is not None:
+        rows = [[soln[var] for var in row] for row in var_array]
+    return {'solved': soln is not None, 'solution': rows,
+            'nDecisions': solver.nDecisions, 'nPrunings': solver.nPrunings,
+            'build_time': build_time, 'solve_time': solve_time}
+
+def _solve_line(index, line, model, propagator, cache_dir=None):
+    '''Parse and solve one input line, never raises'''
+    record = {'index': index}
+    try:
+        item = json.loads(line)
+        if isinstance(item, dict):
+            record['id'] = item.get('id')
+            board = item['board']
+        else:
+            board = item
+        record.update(solve_board(board, model, propagator, cache_dir))
+    except Exception as e:
+        record['error'] = repr(e)
+    return record
+
+def read_lines(stream):
+    '''(index, line) for the non blank lines of stream'''
+    index = 0
+    for line in stream:
+        if line.strip():
+            yield index, line
+            index += 1
+
+def batch_solve(in_stream, out_stream, model=3, propagator='GAC',
+                workers=None, order='input', window=None, cache_dir=None):
+    '''Solve every board of in_stream, writing one JSON line per board
+       to out_stream. workers == number of processes (None: one per
+       CPU, 0: solve in this process). window == most boards read but
+       not yet written (default 4 per worker). cache_dir == csp_store
+       cache for the built models (None: always build). Returns the
+       number of boards processed.'''
+    if order not in ('input', 'completion'):
+        raise ValueError("order must be 'input' or 'completion'")
+
+    def write(record):
+        out_stream.write(json.dumps(record) + '\n')
+
+    n = 0
+    if workers == 0:
+        for index, line in read_lines(in_stream):
+            write(_solve_line(index, line, model, propagator, cache_dir))
+            n += 1
+        return n
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if window is None:
+        window = 4 * workers
+    window = max(1, window)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+
+        def drain(block):
+            '''write finished results, waiting for one if block'''
+            if order == 'input':
+                while pending and (block or pending[0].done()):
+                    write(pending.popleft().result())
+                    block = False
+            else:
+                if not pending:
+                    return
+                done, running = concurrent.futures.wait(
+                    pending, timeout=None if block else 0,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    write(future.result())
+                pending.clear()
+                pending.extend(running)
+
+        for index, line in read_lines(in_stream):
+            while len(pending) >= window:
+                drain(True)
+            pending.append(pool.submit(_solve_line, index, line, model,
+                                       propagator, cache_dir))
+            n += 1
+            drain(False)
+        while pending:
+            drain(True)
+    return n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', help="JSONL file of boards ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="JSONL results file ('-' for stdout)")
+    parser.add_argument('--model', type=int, default=3, choices=(1, 2, 3))
+    parser.add_argument('--prop', default='GAC', choices=sorted(propagators.PROPAGATORS))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default one per CPU, 0 = none)')
+    parser.add_argument('--order', default='input',
+                        choices=('input', 'completion'))
+    parser.add_argument('--window', type=int, default=None,
+                        help='max boards in flight (default 4 per worker)')
+    parser.add_argument('--cache', metavar='DIR', default=None,
+                        help='load/save built models in this csp_store cache')
+    opts = parser.parse_args(argv)
+
+    fin = sys.stdin if opts.input == '-' else open(opts.input)
+    fout = sys.stdout if opts.output == '-' else open(opts.output, 'w')
+    try:
+        batch_solve(fin, fout, opts.model, opts.prop, opts.workers,
+                    opts.order, opts.window, opts.cache)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,21 @@
 from cspbase import *
 import copy
+import functools
 import itertools
 
+# give each distinct set of satisfying tuples to the constraints as one
+# shared Relation (see cspbase.Relation) instead of adding a copy of the
+# tuples to every constraint
+SHARE_RELATIONS = True
+
+# build the '<' and '>' of each row as InequalityConstraint chains (bounds
+# propagation along runs of consecutive inequalities) instead of binary
+# tables of ordered pairs
+BOUNDS_INEQUALITIES = False
+
+# bump when a change to the models makes previously saved ones (see
+# csp_store.cached_model) wrong
+MODEL_VERSION = 1
 
 
 def futoshiki_csp_model_1(initial_futoshiki_board):
@@ -33,6 +47,8 @@ def futoshiki_csp_model_1(initial_futoshiki_board):
             if one > two:
                 one_great_two.append((one,two))
 
+    wo_ineq, one_less_two, one_great_two = relations(wo_ineq, one_less_two,
+                                                     one_great_two)
     #get inequality-in-row constraints
     get_ineq_contraints(board_dim, var_arr, wo_ineq, initial_futoshiki_board, \
                         futoshiki_csp, one_great_two, one_less_two, 1)
@@ -55,7 +71,8 @@ def futoshiki_csp_model_2(initial_futoshiki_board):
     futoshiki_csp = make_CSP(var_arr, board_dim)
 
     #satisfying tuples for variable sets (one_1,one_2,...,one_n) with no inequality
-    wo_ineq = gen_tups(board_dim)
+    #(a function giving a fresh generator of them, see relations)
+    wo_ineq = functools.partial(gen_tups, board_dim)
 
     #satisfying tuples for variable pairs (one,y) such that one < y 
     one_less_two = []
@@ -70,6 +87,8 @@ def futoshiki_csp_model_2(initial_futoshiki_board):
                 # if first is less than second append both in reverse order
                 one_less_two.append((one,two))
                 one_great_two.append((two,one))
+    wo_ineq, one_less_two, one_great_two = relations(wo_ineq, one_less_two,
+                                                     one_great_two)
     #Add inequality constraints
     get_ineq_contraints(board_dim, var_arr, wo_ineq, initial_futoshiki_board, \
                         futoshiki_csp, one_great_two, one_less_two, 2)
@@ -80,10 +99,61 @@ def futoshiki_csp_model_2(initial_futoshiki_board):
     return (futoshiki_csp, var_arr)
 
 
+def futoshiki_csp_model_3(initial_futoshiki_board):
+
+    # like model 2 but the rows and columns use the all-different global
+    # constraint (GAC by matching) instead of n! permutation tuples
+    board_dim = len(initial_futoshiki_board)
+    var_arr = gen_var_arr(board_dim, initial_futoshiki_board)
+    futoshiki_csp = make_CSP(var_arr, board_dim)
+
+    one_less_two = []
+    one_great_two = []
+    for one in range(1, board_dim+1):
+        for two in range(one+1, board_dim+1):
+            one_less_two.append((one,two))
+            one_great_two.append((two,one))
+    one_less_two, one_great_two = relations(one_less_two, one_great_two)
+    #Add inequality constraints
+    get_ineq_contraints(board_dim, var_arr, [], initial_futoshiki_board, \
+                        futoshiki_csp, one_great_two, one_less_two, 3)
+    #Add row and column constraints
+    get_col_constraints(board_dim, var_arr, [], futoshiki_csp, 3)
+    return (futoshiki_csp, var_arr)
+
+
 #########################################################################
 ##############################Supplementary##############################  
 #########################################################################
 
+def model_options():
+    # the settings above that change the CSP the models build (part of
+    # the csp_store cache key)
+    return {'version': MODEL_VERSION,
+            'bounds_inequalities': BOUNDS_INEQUALITIES}
+
+def relations(*tuple_lists):
+    # turn lists of satisfying tuples (or functions returning a fresh
+    # iterable of them) into shared relations
+    if not SHARE_RELATIONS:
+        # each constraint adds its own copy: keep the functions, so each
+        # constraint streams its own tuples instead of copying a list of
+        # all of them
+        return tuple(tups if callable(tups) else list(tups)
+                     for tups in tuple_lists)
+    return tuple(Relation(tups() if callable(tups) else tups)
+                 for tups in tuple_lists)
+
+def add_tuples(constraint, tuples):
+    # tuples is a Relation, a list of satisfying tuples or a function
+    # returning an iterable of them
+    if isinstance(tuples, Relation):
+        constraint.set_relation(tuples)
+    elif callable(tuples):
+        constraint.add_satisfying_tuples(tuples())
+    else:
+        constraint.add_satisfying_tuples(tuples)
+
 def make_CSP(var_arr, board_dim):
     # construct fukoshiki csp
 
@@ -124,11 +194,18 @@ def get_ineq_contraints(board_dim, var_arr, wo_ineq, initial_futoshiki_board, \
     # function for both models
     # formatting done as per model_id
 
+    if BOUNDS_INEQUALITIES:
+        get_ineq_chains(board_dim, var_arr, initial_futoshiki_board, futoshiki_csp)
+
     for item in range(board_dim):
         for attr_1 in range(board_dim):
             for attr_2 in range(attr_1 + 1, board_dim):
                 # get row, collumn attributes in board
                 # get up attr1 up until the end of board
+                if BOUNDS_INEQUALITIES and attr_2 == (attr_1+1) and \
+                   initial_futoshiki_board[item][(attr_1*2)+1] in ('<', '>'):
+                    # already in a chain (which also makes them differ)
+                    continue
                 if model_id == 1:
                     # if model one  only binary not equal constraints for the row and column
                     # constraints, and binary inequality constraints.
@@ -138,32 +215,55 @@ def get_ineq_contraints(board_dim, var_arr, wo_ineq, initial_futoshiki_board, \
                             (var_arr[item][attr_1], var_arr[item][attr_2]))
                     # cjcelc of greater
                     if attr_2 == (attr_1+1) and initial_futoshiki_board[item][(attr_1*2)+1] == '>':
-                        constraint.add_satisfying_tuples(one_great_y)
+                        add_tuples(constraint, one_great_y)
                     # check if less than
                     elif attr_2 == (attr_1+1) and initial_futoshiki_board[item][(attr_1*2)+1] == '<':
-                        constraint.add_satisfying_tuples(one_less_y)
+                        add_tuples(constraint, one_less_y)
                     else:
                         # else there is no inequality
-                        constraint.add_satisfying_tuples(wo_ineq)
+                        add_tuples(constraint, wo_ineq)
                     futoshiki_csp.add_constraint(constraint)
                 else:
-                    # if model two all-different constraints for the row and column constraints,
-                    # and binary inequality constraints.
+                    # if model two (or three) all-different constraints for the row and column
+                    # constraints, and binary inequality constraints.
 
                     # initialize constraint
                     constraint = Constraint('[({},{})({},{})]'.format(item,attr_1,item,attr_2), 
                             (var_arr[item][attr_1], var_arr[item][attr_2]))
                     # check if greater than
                     if attr_2 == (attr_1+1) and initial_futoshiki_board[item][(attr_1*2)+1] == '>':
-                        constraint.add_satisfying_tuples(one_great_y)
+                        add_tuples(constraint, one_great_y)
                         futoshiki_csp.add_constraint(constraint)
                     # check if less than
                     elif attr_2 == (attr_1+1) and initial_futoshiki_board[item][(attr_1*2)+1] == '<':
-                        constraint.add_satisfying_tuples(one_less_y)
+                        add_tuples(constraint, one_less_y)
                         futoshiki_csp.add_constraint(constraint)
 
     return futoshiki_csp
 
+def get_ineq_chains(board_dim, var_arr, initial_futoshiki_board, futoshiki_csp):
+    # one inequality constraint for each run of consecutive '<'/'>' signs
+    # in a row, e.g. a < b > c becomes a single chain over (a, b, c)
+    for item in range(board_dim):
+        start = 0
+        ops = ''
+        for col in range(board_dim):
+            sign = None
+            if col < board_dim - 1:
+                sign = initial_futoshiki_board[item][(col*2)+1]
+            if sign in ('<', '>'):
+                if not ops:
+                    start = col
+                ops += sign
+            elif ops:
+                # the run ends at this cell
+                constraint = InequalityConstraint(
+                    '[({},{})..({},{})]'.format(item, start, item, col),
+                    tuple(var_arr[item][start:col+1]), ops)
+                futoshiki_csp.add_constraint(constraint)
+                ops = ''
+    return futoshiki_csp
+
 def get_col_constraints(board_dim, var_arr, wo_ineq, futoshiki_csp, model_id):
     # get column contraints for both models
 
@@ -177,8 +277,11 @@ def get_col_constraints(board_dim, var_arr, wo_ineq, futoshiki_csp, model_id):
             for col in range(board_dim):
                 var_scp.append(var_arr[item][col])
             # get no inequality tuples and add satisfying tuples
-            constraint = Constraint('[item {}]'.format(item), tuple(var_scp))
-            constraint.add_satisfying_tuples(wo_ineq)
+            if model_id == 3:
+                constraint = AllDiffConstraint('[item {}]'.format(item), tuple(var_scp))
+            else:
+                constraint = Constraint('[item {}]'.format(item), tuple(var_scp))
+                add_tuples(constraint, wo_ineq)
             futoshiki_csp.add_constraint(constraint)
 
     for col in range(board_dim):
@@ -188,34 +291,22 @@ def get_col_constraints(board_dim, var_arr, wo_ineq, futoshiki_csp, model_id):
                 for attr_2 in range(attr_1 + 1, board_dim):
                     constraint = Constraint('[({},{})({},{})]'.format(attr_1,col,attr_2,col),
                         (var_arr[attr_1][col], var_arr[attr_2][col]))
-                    constraint.add_satisfying_tuples(wo_ineq)
+                    add_tuples(constraint, wo_ineq)
                     futoshiki_csp.add_constraint(constraint)
         else:
             var_scp = []
             for item in range(board_dim):
                 var_scp.append(var_arr[item][col])
-            constraint = Constraint('[col {}]'.format(col), tuple(var_scp))
-            constraint.add_satisfying_tuples(wo_ineq)
+            if model_id == 3:
+                constraint = AllDiffConstraint('[col {}]'.format(col), tuple(var_scp))
+            else:
+                constraint = Constraint('[col {}]'.format(col), tuple(var_scp))
+                add_tuples(constraint, wo_ineq)
             futoshiki_csp.add_constraint(constraint)
 
     return futoshiki_csp
 
-def gen_tups(n, tups=[[1]]): 
-    #generate all tuples of length n
-    if len(tups[0]) != n:
-        # get level
-        attr = len(tups[0]) + 1
-        temp = []
-        for item in tups:
-            for var in range(0, (len(item)+1)):
-                new = copy.deepcopy(item)
-                new.insert(var, attr)
-                temp.append(new)
-        return gen_tups(n, temp)
-    else:
-        return_list = []
-        for item in tups:
-            return_list.append(tuple(item))
-        return return_list
-
-        
\ No newline at end of file
+def gen_tups(n):
+    #generate all permutations of 1..n as tuples, one at a time (no
+    #list of them is ever built, constraints consume them as they come)
+    return itertools.permutations(range(1, n+1))
@@ -22,3 +22,11 @@ solver.bt_search(prop_GAC)
 print("Solution")
 print_sudo_soln(var_array)
 print("===========")
+
+csp,var_array = futoshiki_csp_model_3(puzzle1)
+solver = BT(csp)
+print("GAC")
+solver.bt_search(prop_GAC)
+print("Solution")
+print_sudo_soln(var_array)
+print("===========")
@@ -27,14 +27,16 @@ propagator == a function with the following template
     Returns False if a deadend has been detected by the propagator.
         in this case bt_search will backtrack
     Returns True if we can continue.
+    Before returning False a propagator reports the constraint that
+    failed with csp.constraint_failed(constraint) (this drives the
+    dom/wdeg variable ordering of bt_search).
 
-    The list of variable values pairs are all of the values
-    the propagator pruned (using the variable's prune_value method).
-    bt_search NEEDS to know this in order to correctly restore these
-    values when it undoes a variable assignment.
-
-    NOTE propagator SHOULD NOT prune a value that has already been
-    pruned! Nor should it prune a value twice
+    Values must be pruned with the variable's prune_value method.
+    Inside bt_search every pruning is recorded on the solver's trail
+    (see cspbase.Trail) and undone when the search backtracks, so the
+    propagators below no longer build a list of pruned (Variable, Value)
+    pairs: they return an empty list, which bt_search ignores. Pruning
+    a value that has already been pruned is harmless.
 
     PROPAGATOR called with newly_instantiated_variable = None
         PROCESSING REQUIRED:
@@ -61,6 +63,10 @@ propagator == a function with the following template
             V.
 '''
 
+from collections import deque
+
+from cspbase import _popcount, REMOVED, BOUNDS, ASSIGNED
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no
     propagation at all. Just check fully instantiated constraints'''
@@ -74,12 +80,12 @@ def prop_BT(csp, newVar=None):
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                csp.constraint_failed(c)
                 return False, []
     return True, []
 
 def prop_FC(csp, newVar=None):
     single = []
-    prune = []
 
     constraints = csp.get_all_cons()
     if newVar != None:
@@ -117,15 +123,15 @@ def prop_FC(csp, newVar=None):
 
             if not constraint.check(temp):
                 # prune
-                prune.append((unassigned, item))
                 unassigned.prune_value(item)
 
-                if len(unassigned.cur_domain()) == 0: 
+                if unassigned.cur_domain_size() == 0:
                     # if length is 0 then return false
-                    return (False, prune)
+                    csp.constraint_failed(constraint)
+                    return (False, [])
 
 
-    return (True, prune)
+    return (True, [])
 
 def single_constraints_FC(constraints):
     single = []
@@ -142,30 +148,590 @@ def single_constraints_FC(constraints):
     return single
 
 
-def prop_GAC(csp, newVar=None):
+def prop_GAC(csp, newVar=None, skip_source=True):
+    '''GAC propagation over a FIFO queue of constraints.
 
-    constraints = csp.get_all_cons()
-    if newVar != None: 
-        constraints = csp.get_cons_with_var(newVar)
+    Each queued constraint remembers which of its variables changed
+    (None == revise everything, as at the root). A variable's values
+    only need revising if some OTHER variable of the constraint changed,
+    so a constraint requeued because x lost values does not revise x.
 
-    # prune values
-    prune = []
-    while len(constraints) > 0:
+    skip_source == do not requeue the constraint whose revision pruned
+    the values. This is sound: a value is only pruned when none of the
+    constraint's tuples containing it are valid, so removing it cannot
+    take a support away from any other variable of that constraint.'''
 
-        constraint = constraints.pop(0)
-        items = constraint.get_scope()
+    if newVar != None:
+        constraints = csp.get_cons_with_var(newVar)
+        changed = newVar
+    else:
+        constraints = csp.get_all_cons()
+        changed = None
 
-        for i in items:
-            for val in i.cur_domain():
+    queue = deque()
+    pending = dict()    # queued constraint --> set of changed vars/None
+    for constraint in constraints:
+        if constraint not in pending:
+            queue.append(constraint)
+            pending[constraint] = None if changed is None else {changed}
+
+    # prune values
+    while queue:
+
+        constraint = queue.popleft()
+        changed = pending.pop(constraint)
+
+        for i in constraint.scope:
+            if changed is not None and (len(changed) == 1 and i in changed):
+                continue
+            if i.is_assigned():
+                # its only value must stay supported
+                if not constraint.has_support(i, i.get_assigned_value()):
+                    csp.constraint_failed(constraint)
+                    return (False, [])
+                continue
+            pruned = False
+            for val in i.cur_domain_iter():
 
                 # find values to prune and commence with the pruning
                 if constraint.has_support(i, val) == False:
-                    prune.append((i, val))
                     i.prune_value(val)
-                    if len(i.cur_domain()) == 0:
-                        return (False, prune)
-                    else:
-                        for new in csp.get_cons_with_var(i):
-                            if new not in constraints:
-                                constraints.append(new)
-    return (True, prune)
+                    pruned = True
+            if not pruned:
+                continue
+            if i.cur_domain_size() == 0:
+                csp.constraint_failed(constraint)
+                return (False, [])
+
+            for new in csp.vars_to_cons[i]:
+                if skip_source and new is constraint:
+                    continue
+                if new not in pending:
+                    queue.append(new)
+                    pending[new] = {i}
+                elif pending[new] is not None:
+                    pending[new].add(i)
+    return (True, [])
+
+
+class CompactTable:
+    '''Compact-Table (CT) state for one table constraint, used by
+    prop_CT to make the whole constraint GAC with bitwise operations
+    instead of one has_support scan per value.
+
+    The satisfying tuples are numbered and sets of tuples are Python
+    ints used as bitsets (CPython does &, |, ~ a machine word at a time
+    and drops leading zero words, so a shrinking table gets cheaper).
+        supports[pos][i] == tuples with scope[pos] = scope[pos].dom[i]
+        curr_table       == tuples that are still valid
+        last             == domain masks of the scope when curr_table
+                            was last brought up to date
+
+    curr_table and last are reversible: changes are recorded on the
+    trail of the variables (see cspbase.Trail) and put back on
+    backtrack. Outside bt_search, a domain that grew since the last
+    call (e.g. restore_curdom) is detected and the table rebuilt.'''
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+        self.scope = constraint.get_scope()
+        self.ntuples = len(constraint.sat_tuples)
+        tuples = list(constraint.sat_tuples)
+        nbytes = (len(tuples) + 7) // 8
+
+        #tuple numbers per (pos, value index), tuples with values
+        #outside a variable's domain are never valid
+        rows = [[[] for i in range(len(var.dom))] for var in self.scope]
+        valid = bytearray(nbytes)
+        for k, t in enumerate(tuples):
+            idxs = []
+            for var, val in zip(self.scope, t):
+                i = var.dom_index.get(val)
+                if i is None:
+                    break
+                idxs.append(i)
+            else:
+                valid[k >> 3] |= 1 << (k & 7)
+                for pos, i in enumerate(idxs):
+                    rows[pos][i].append(k)
+
+        self.initial = int.from_bytes(bytes(valid), 'little')
+        self.supports = []
+        for row in rows:
+            masks = []
+            for ks in row:
+                buf = bytearray(nbytes)
+                for k in ks:
+                    buf[k >> 3] |= 1 << (k & 7)
+                masks.append(int.from_bytes(bytes(buf), 'little'))
+            self.supports.append(masks)
+
+        self.curr_table = self.initial
+        self.last = (None,) * len(self.scope)
+
+    def restore_state(self, state):
+        '''Used by Trail on backtrack'''
+        self.curr_table, self.last = state
+
+    def _save(self):
+        trail = self.scope[0].trail
+        if trail is not None:
+            trail.record(self, (self.curr_table, self.last))
+
+    def filter(self):
+        '''Make the constraint GAC. Returns the list of scope variables
+        that had values pruned, or None on a domain wipeout'''
+        scope = self.scope
+        masks = [var.cur_mask() for var in scope]
+        last = self.last
+        if tuple(masks) == last:
+            return []
+
+        #update curr_table from the domain changes since last time
+        reset = False
+        for m, l in zip(masks, last):
+            if l is None or m & ~l:
+                reset = True
+                break
+        curr = self.initial if reset else self.curr_table
+        for pos, m in enumerate(masks):
+            l = last[pos]
+            if not reset and m == l:
+                continue
+            sup = self.supports[pos]
+            u = 0
+            if reset or _popcount(m) <= _popcount(l & ~m):
+                #fewer values left than removed: keep tuples of those
+                bits = m
+                while bits:
+                    low = bits & -bits
+                    u |= sup[low.bit_length() - 1]
+                    bits ^= low
+                curr &= u
+            else:
+                bits = l & ~m
+                while bits:
+                    low = bits & -bits
+                    u |= sup[low.bit_length() - 1]
+                    bits ^= low
+                curr &= ~u
+            if not curr:
+                return None
+
+        #prune values that lost all their valid tuples
+        self._save()
+        pruned = []
+        for pos, var in enumerate(scope):
+            if var.is_assigned():
+                continue    #curr only has tuples with assigned values
+            sup = self.supports[pos]
+            m = masks[pos]
+            bits = m
+            while bits:
+                low = bits & -bits
+                i = low.bit_length() - 1
+                if not sup[i] & curr:
+                    var.prune_value(var.dom[i])
+                    m ^= low
+                bits ^= low
+            if m != masks[pos]:
+                if not m:
+                    return None
+                masks[pos] = m
+                pruned.append(var)
+
+        self.curr_table = curr
+        self.last = tuple(masks)
+        return pruned
+
+
+def compact_table(constraint):
+    '''Return the CompactTable of a table constraint, building it on
+    first use (or if tuples were added since)'''
+    ct = getattr(constraint, 'compact_table', None)
+    if ct is None or ct.ntuples != len(constraint.sat_tuples):
+        ct = CompactTable(constraint)
+        constraint.compact_table = ct
+    return ct
+
+
+def revise_constraint(constraint, skip=None):
+    '''Make constraint GAC value by value with has_support. Returns the
+    list of scope variables that had values pruned, or None on a domain
+    wipeout. skip == a variable whose values are known to be supported
+    (the only one whose domain changed since the constraint was GAC)'''
+    pruned = []
+    for var in constraint.get_scope():
+        if var is skip:
+            continue
+        if var.is_assigned():
+            if not constraint.has_support(var, var.get_assigned_value()):
+                return None
+            continue
+        changed = False
+        for val in var.cur_domain_iter():
+            if not constraint.has_support(var, val):
+                var.prune_value(val)
+                changed = True
+        if changed:
+            if var.cur_domain_size() == 0:
+                return None
+            pruned.append(var)
+    return pruned
+
+
+def prop_CT(csp, newVar=None):
+    '''GAC propagator that filters table constraints with Compact-Table
+    (see CompactTable). Constraints without a table are revised with
+    has_support. Same queue initialisation as prop_GAC.'''
+
+    constraints = csp.get_all_cons()
+    if newVar != None:
+        constraints = csp.get_cons_with_var(newVar)
+    queue = deque(constraints)
+    queued = set(constraints)
+
+    while queue:
+        constraint = queue.popleft()
+        queued.discard(constraint)
+        if constraint.sat_tuples:
+            pruned = compact_table(constraint).filter()
+        else:
+            pruned = revise_constraint(constraint)
+        if pruned is None:
+            csp.constraint_failed(constraint)
+            return (False, [])
+        # values removed from a variable may take supports away from
+        # the other constraints on it (not this one: it is now GAC)
+        for var in pruned:
+            for new in csp.vars_to_cons[var]:
+                if new is not constraint and new not in queued:
+                    queue.append(new)
+                    queued.add(new)
+    return (True, [])
+
+
+class BinarySupports:
+    '''Support bitmasks of a binary constraint over scope (x, y):
+        masks[0][i] == bitmask over y.dom positions of the values of y
+                       compatible with x = x.dom[i]
+        masks[1][j] == the same for y = y.dom[j] over x.dom positions
+    so the values of one variable still supported by the current domain
+    of the other are found with bitwise ANDs and ORs (see filter)
+    instead of building value lists and calling check. Table
+    constraints are compiled from their tuples, others by calling
+    check on every pair of values.'''
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+        self.scope = constraint.get_scope()
+        x, y = self.scope
+        self.ntuples = len(constraint.sat_tuples)
+        self.sizes = (len(x.dom), len(y.dom))
+        sx = [0] * len(x.dom)
+        sy = [0] * len(y.dom)
+        if constraint.sat_tuples:
+            for a, b in constraint.sat_tuples:
+                i = x.dom_index.get(a)
+                j = y.dom_index.get(b)
+                if i is not None and j is not None:
+                    sx[i] |= 1 << j
+                    sy[j] |= 1 << i
+        else:
+            for i, a in enumerate(x.dom):
+                for j, b in enumerate(y.dom):
+                    if constraint.check([a, b]):
+                        sx[i] |= 1 << j
+                        sy[j] |= 1 << i
+        self.masks = (sx, sy)
+
+    def filter(self, pos, mask, other_mask):
+        '''Return the values of mask (a domain mask of scope[pos]) that
+        have a support in other_mask (a domain mask of the other
+        variable)'''
+        if _popcount(other_mask) <= _popcount(mask):
+            #union of the supports of the other variable's values
+            sup = self.masks[1 - pos]
+            u = 0
+            while other_mask:
+                low = other_mask & -other_mask
+                u |= sup[low.bit_length() - 1]
+                other_mask ^= low
+            return mask & u
+        sup = self.masks[pos]
+        bits = mask
+        while bits:
+            low = bits & -bits
+            if not sup[low.bit_length() - 1] & other_mask:
+                mask ^= low
+            bits ^= low
+        return mask
+
+    def revise(self, pos):
+        '''Prune the values of scope[pos] with no support in the other
+        variable's current domain. Returns True if values were pruned,
+        False if not, None if scope[pos] is left without a value (or
+        its assigned value is unsupported)'''
+        var = self.scope[pos]
+        mask = var.cur_mask()
+        new = self.filter(pos, mask, self.scope[1 - pos].cur_mask())
+        if new == mask:
+            return False
+        if not new or var.is_assigned():
+            return None
+        var.restrict_domain(new)
+        return True
+
+
+def binary_supports(constraint):
+    '''Return the BinarySupports of a binary constraint, building it on
+    first use (or if tuples or domain values were added since)'''
+    bs = getattr(constraint, 'binary_supports', None)
+    x, y = constraint.scope
+    if (bs is None or bs.ntuples != len(constraint.sat_tuples) or
+            bs.sizes != (len(x.dom), len(y.dom))):
+        bs = BinarySupports(constraint)
+        constraint.binary_supports = bs
+    return bs
+
+
+def _is_binary(constraint):
+    scope = constraint.scope
+    return len(scope) == 2 and scope[0] is not scope[1]
+
+
+def prop_FC_bits(csp, newVar=None):
+    '''prop_FC, except that a binary constraint with one unassigned
+    variable is forward checked with a single AND of the assigned
+    value's support mask against the unassigned variable's domain
+    (see BinarySupports)'''
+
+    constraints = csp.get_all_cons()
+    if newVar != None:
+        constraints = csp.vars_to_cons[newVar]
+
+    for constraint, unassigned in single_constraints_FC(constraints):
+        if _is_binary(constraint):
+            pos = 0 if constraint.scope[0] is unassigned else 1
+            if binary_supports(constraint).revise(pos) is None:
+                csp.constraint_failed(constraint)
+                return (False, [])
+            continue
+
+        vals = [var.get_assigned_value() for var in constraint.scope]
+        k = constraint.scope.index(unassigned)
+        for item in unassigned.cur_domain_iter():
+            vals[k] = item
+            if not constraint.check(vals):
+                unassigned.prune_value(item)
+        if unassigned.cur_domain_size() == 0:
+            csp.constraint_failed(constraint)
+            return (False, [])
+    return (True, [])
+
+
+def prop_GAC_bits(csp, newVar=None):
+    '''prop_GAC, except that binary constraints are revised with their
+    support masks (see BinarySupports): each value costs one AND
+    against the neighbour's domain, or, when the neighbour has fewer
+    values left, the neighbour's supports are ORed together once.
+    Other constraints are revised with has_support as in prop_GAC.'''
+
+    if newVar != None:
+        constraints = csp.vars_to_cons[newVar]
+        changed = newVar
+    else:
+        constraints = csp.get_all_cons()
+        changed = None
+
+    queue = deque()
+    pending = dict()    # queued constraint --> set of changed vars/None
+    for constraint in constraints:
+        if constraint not in pending:
+            queue.append(constraint)
+            pending[constraint] = None if changed is None else {changed}
+
+    while queue:
+        constraint = queue.popleft()
+        changed = pending.pop(constraint)
+        binary = _is_binary(constraint)
+        if binary:
+            bs = binary_supports(constraint)
+
+        for pos, i in enumerate(constraint.scope):
+            if changed is not None and (len(changed) == 1 and i in changed):
+                continue
+            if binary:
+                pruned = bs.revise(pos)
+                if pruned is None:
+                    csp.constraint_failed(constraint)
+                    return (False, [])
+            elif i.is_assigned():
+                if not constraint.has_support(i, i.get_assigned_value()):
+                    csp.constraint_failed(constraint)
+                    return (False, [])
+                continue
+            else:
+                pruned = False
+                for val in i.cur_domain_iter():
+                    if not constraint.has_support(i, val):
+                        i.prune_value(val)
+                        pruned = True
+                if pruned and i.cur_domain_size() == 0:
+                    csp.constraint_failed(constraint)
+                    return (False, [])
+            if not pruned:
+                continue
+
+            for new in csp.vars_to_cons[i]:
+                if new is constraint:
+                    continue
+                if new not in pending:
+                    queue.append(new)
+                    pending[new] = {i}
+                elif pending[new] is not None:
+                    pending[new].add(i)
+    return (True, [])
+
+
+class PropagationEngine:
+    '''Event driven constraint propagation.
+
+    Every constraint subscribes to the domain events (cspbase REMOVED,
+    BOUNDS, ASSIGNED, as bit flags in its events attribute) of its scope
+    variables. When a constraint has been propagated the domains of its
+    scope are compared with what they were before; each variable that
+    changed raises its events, and only the constraints subscribed to
+    one of them are woken up. A woken constraint is queued once, with
+    the delta of each changed variable (bitmask of the values removed
+    since it was queued) merged in.
+
+    How a constraint is propagated is looked up in this order:
+        constraint.propagate(delta)  new constraint types: delta is a
+                                     dict var --> removed values mask
+                                     (None: anything may have changed),
+                                     return False on a wipeout
+        table constraints            Compact-Table (see CompactTable)
+        others                       GAC with has_support, skipping the
+                                     variable that woke it if it was the
+                                     only one
+
+    A constraint is assumed to leave itself consistent (so it is not
+    woken by its own prunings) unless its idempotent attribute is
+    False.'''
+
+    def __init__(self, csp):
+        self.csp = csp
+        self.ncons = len(csp.cons)
+        self.subscribers = dict()   #var --> [(constraint, events)]
+        for var in csp.vars:
+            self.subscribers[var] = []
+        for c in csp.cons:
+            events = getattr(c, 'events', REMOVED)
+            for var in set(c.scope):
+                self.subscribers[var].append((c, events))
+        self.nWakeups = 0   #constraints propagated
+
+    def events(self, var, old, new):
+        '''Events raised by var's domain going from mask old to new'''
+        if new == old:
+            return 0
+        ev = REMOVED
+        if not new & (new - 1):
+            ev |= ASSIGNED | BOUNDS
+        elif (not var._sorted or (old & -old) != (new & -new) or
+              old.bit_length() != new.bit_length()):
+            ev |= BOUNDS
+        return ev
+
+    def propagate(self, newVar=None):
+        '''Propagate after newVar was assigned (everything if None).
+        Returns False on a domain wipeout.'''
+        queue = deque()
+        pending = dict()    #queued constraint --> delta
+        if newVar is None:
+            for c in self.csp.cons:
+                queue.append(c)
+                pending[c] = None
+        else:
+            old = newVar.curdom
+            self.wake(newVar, old, newVar.cur_mask(), None, queue, pending)
+
+        while queue:
+            c = queue.popleft()
+            delta = pending.pop(c)
+            scope = c.scope
+            before = [var.cur_mask() for var in scope]
+            self.nWakeups += 1
+            if not self.run(c, delta):
+                self.csp.constraint_failed(c)
+                return False
+            source = c if getattr(c, 'idempotent', True) else None
+            for var, old in zip(scope, before):
+                new = var.cur_mask()
+                if new != old:
+                    if not new:
+                        self.csp.constraint_failed(c)
+                        return False
+                    self.wake(var, old, new, source, queue, pending)
+        return True
+
+    def wake(self, var, old, new, source, queue, pending):
+        '''Queue the subscribers of the events of var going from old to
+        new (but not source), adding the removed values to their delta'''
+        ev = self.events(var, old, new)
+        if not ev:
+            return
+        removed = old & ~new
+        for c, events in self.subscribers[var]:
+            if c is source or not events & ev:
+                continue
+            if c not in pending:
+                queue.append(c)
+                pending[c] = {var: removed}
+            else:
+                delta = pending[c]
+                if delta is not None:
+                    delta[var] = delta.get(var, 0) | removed
+
+    def run(self, c, delta):
+        '''Propagate constraint c, returns False on a wipeout'''
+        propagate = getattr(c, 'propagate', None)
+        if propagate is not None:
+            return propagate(delta)
+        if c.sat_tuples:
+            return compact_table(c).filter() is not None
+        skip = None
+        if delta is not None and len(delta) == 1:
+            skip = next(iter(delta))
+        return revise_constraint(c, skip) is not None
+
+
+def propagation_engine(csp):
+    '''Return the PropagationEngine of csp, building it on first use
+    (or if constraints were added since)'''
+    engine = getattr(csp, 'engine', None)
+    if engine is None or engine.ncons != len(csp.cons):
+        engine = PropagationEngine(csp)
+        csp.engine = engine
+    return engine
+
+
+def prop_events(csp, newVar=None):
+    '''GAC propagator running the csp's PropagationEngine: only the
+    constraints woken up by the domain events they subscribe to are
+    propagated again.'''
+    if not propagation_engine(csp).propagate(newVar):
+        return (False, [])
+    return (True, [])
+
+
+#propagators by the names the command line tools (csp_benchmark.py,
+#futoshiki_batch.py) know them by
+PROPAGATORS = {'BT': prop_BT,
+               'FC': prop_FC,
+               'GAC': prop_GAC,
+               'CT': prop_CT,
+               'FC-bits': prop_FC_bits,
+               'GAC-bits': prop_GAC_bits,
+               'events': prop_events}
@@ -0,0 +1,961 @@
+from cspbase import *
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import traceback
+
+import propagators
+import futoshiki_csp
+import csp_compiled
+import csp_parallel
+import futoshiki_batch
+import csp_store
+
+
+########################################
+##Necessary setup to generate problems
+
+def queensCheck(qi, qj, i, j):
+    '''Return true if i and j can be assigned to the queen in row qi and row qj
+       respectively. Used to find satisfying tuples.
+    '''
+    return i != j and abs(i-j) != abs(qi-qj)
+
+def nQueens(n):
+    '''Return an n-queens CSP with table constraints'''
+    dom = list(range(1, n+1))
+    vars = [Variable('Q{}'.format(i), dom) for i in dom]
+    csp = CSP("{}-Queens".format(n), vars)
+    for qi in range(n):
+        for qj in range(qi+1, n):
+            con = Constraint("C(Q{},Q{})".format(qi+1,qj+1),[vars[qi], vars[qj]])
+            con.add_satisfying_tuples([t for t in itertools.product(dom, dom)
+                                       if queensCheck(qi, qj, t[0], t[1])])
+            csp.add_constraint(con)
+    return csp
+
+##number of solutions of n-queens for n = 4..7
+QUEENS_COUNTS = {4: 2, 5: 10, 6: 4, 7: 40}
+
+def pigeonhole(n):
+    '''n pigeons in n-1 holes, pairwise different (no solution)'''
+    dom = list(range(n-1))
+    vars = [Variable('P{}'.format(i), dom) for i in range(n)]
+    csp = CSP("{}-Pigeons".format(n), vars)
+    for x, y in itertools.combinations(vars, 2):
+        con = Constraint("C({},{})".format(x.name, y.name), [x, y])
+        con.add_satisfying_tuples([t for t in itertools.product(dom, dom) if t[0] != t[1]])
+        csp.add_constraint(con)
+    return csp
+
+def count(csp, propagator, limit=None, **options):
+    '''(number of solutions, decisions) of a full search'''
+    solver = BT(csp, **options)
+    n = solver.bt_count(propagator, limit)
+    return n, solver.nDecisions
+
+def empty_board(n):
+    '''futoshiki board without givens or inequalities (a latin square)'''
+    return [[0 if k % 2 == 0 else '.' for k in range(2*n - 1)] for r in range(n)]
+
+##puzzle1 of futoshiki_sample_run.py and a 5x5 board with a chain a < b < c < d
+PUZZLES = [[[3,'.',0,'.',0,'<',0],[0,'.',0,'.',0,'.',0],[0,'.',0,'<',0,'.',0],[0,'.',0,'>',0,'.',1]],
+           [[0,'.',0,'<',0,'.',0,'.',0],[0,'.',0,'.',0,'.',0,'.',0],[0,'<',0,'<',0,'<',0,'.',0],[0,'.',0,'.',0,'.',0,'>',0],[0,'.',0,'.',0,'.',0,'.',0]]]
+
+############################################
+
+##Compact-Table keeps its tuple sets across backtracking: counting every
+##solution with prop_CT must give the same counts and decisions as prop_GAC
+def test_compact_table():
+	score = 0
+	print("---starting test_compact_table---")
+	try:
+		did_fail = False
+		for n, expected in sorted(QUEENS_COUNTS.items()):
+			gac = count(nQueens(n), propagators.prop_GAC)
+			ct = count(nQueens(n), propagators.prop_CT)
+			if gac[0] != expected or ct != gac:
+				print("FAILED test_compact_table\nExplanation:\n%d-queens solutions, decisions should be: %r\nprop_CT gives: %r" % (n, (expected, gac[1]), ct))
+				did_fail = True
+				break
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_compact_table---\n")
+	return score
+
+
+##Regin's filtering removes values no maximum matching uses, and a scope
+##with fewer values than variables fails at once; model 3 (all-different)
+##must have the same solutions as model 2 (permutation tables)
+def test_alldiff():
+	score = 0
+	print("---starting test_alldiff---")
+	try:
+		did_fail = False
+		a = Variable('A', [1, 2])
+		b = Variable('B', [1, 2])
+		c = Variable('C', [1, 2, 3])
+		d = Variable('D', [1, 2, 3, 4])
+		simpleCSP = CSP("AllDiff", [a, b, c, d])
+		simpleCSP.add_constraint(AllDiffConstraint("AD", [a, b, c, d]))
+		propagators.prop_GAC(simpleCSP)
+		answer = [[1, 2], [1, 2], [3], [4]]
+		var_vals = [x.cur_domain() for x in simpleCSP.get_all_vars()]
+		if var_vals != answer:
+			print("FAILED test_alldiff\nExplanation:\nGAC variable domains should be: %r\nGAC variable domains are: %r" % (answer, var_vals))
+			did_fail = True
+
+		e = Variable('E', [1, 2])
+		pigeons = CSP("Pigeons", [a, b, e])
+		pigeons.add_constraint(AllDiffConstraint("AD", [a, b, e]))
+		if not did_fail and propagators.prop_GAC(pigeons)[0]:
+			print("FAILED test_alldiff\nExplanation:\n3 variables with 2 values should fail at the root")
+			did_fail = True
+
+		boards = [empty_board(4)] + PUZZLES
+		for board in boards:
+			if did_fail:
+				break
+			tables = count(futoshiki_csp.futoshiki_csp_model_2(board)[0], propagators.prop_GAC)
+			alldiff = count(futoshiki_csp.futoshiki_csp_model_3(board)[0], propagators.prop_GAC)
+			if alldiff[0] != tables[0]:
+				print("FAILED test_alldiff\nExplanation:\nmodel 2 has %d solutions, model 3 has %d for board %r" % (tables[0], alldiff[0], board))
+				did_fail = True
+		if not did_fail and count(futoshiki_csp.futoshiki_csp_model_3(empty_board(4))[0], propagators.prop_GAC)[0] != 576:
+			print("FAILED test_alldiff\nExplanation:\nthere are 576 latin squares of order 4")
+			did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_alldiff---\n")
+	return score
+
+
+##nogoods recorded at restarts must not cut off solutions, nor stop an
+##unsatisfiable search from finishing: with a tiny cutoff (so there are
+##many restarts) every count must be the chronological one
+def test_restarts():
+	score = 0
+	print("---starting test_restarts---")
+	try:
+		did_fail = False
+		cases = [(n, expected, propagators.prop_BT) for n, expected in sorted(QUEENS_COUNTS.items())]
+		cases += [(8, 92, propagators.prop_FC), (8, 92, propagators.prop_GAC)]
+		nRestarts = 0
+		for schedule in ('luby', 'geometric'):
+			for n, expected, prop in cases:
+				solver = BT(nQueens(n), restarts=schedule, restart_base=1, seed=n)
+				got = solver.bt_count(prop)
+				nRestarts += solver.nRestarts
+				if got != expected:
+					print("FAILED test_restarts\nExplanation:\n%d-queens with %s restarts and %s should have %d solutions, found %d" % (n, schedule, prop.__name__, expected, got))
+					did_fail = True
+			solver = BT(pigeonhole(5), restarts=schedule, restart_base=1, seed=0)
+			got = solver.bt_count(propagators.prop_GAC)
+			nRestarts += solver.nRestarts
+			if got != 0:
+				print("FAILED test_restarts\nExplanation:\npigeonhole(5) has no solutions")
+				did_fail = True
+		if not did_fail and nRestarts == 0:
+			print("FAILED test_restarts\nExplanation:\nno restart happened")
+			did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_restarts---\n")
+	return score
+
+
+##dom/wdeg only changes the order variables are chosen in: every
+##propagator must still count the same solutions, and failures must
+##have raised some constraint weights
+def test_domwdeg():
+	score = 0
+	print("---starting test_domwdeg---")
+	try:
+		did_fail = False
+		for n, expected in sorted(QUEENS_COUNTS.items()):
+			for prop in (propagators.prop_BT, propagators.prop_FC, propagators.prop_GAC):
+				csp = nQueens(n)
+				got = count(csp, prop, var_order='domwdeg')[0]
+				if got != expected:
+					print("FAILED test_domwdeg\nExplanation:\n%d-queens with dom/wdeg and %s should have %d solutions, found %d" % (n, prop.__name__, expected, got))
+					did_fail = True
+		if not did_fail and max(c.weight for c in csp.get_all_cons()) <= 1:
+			print("FAILED test_domwdeg\nExplanation:\nno constraint weight was raised")
+			did_fail = True
+		for board in PUZZLES:
+			if did_fail:
+				break
+			mrv = count(futoshiki_csp.futoshiki_csp_model_3(board)[0], propagators.prop_GAC)[0]
+			wdeg = count(futoshiki_csp.futoshiki_csp_model_3(board)[0], propagators.prop_GAC, var_order='domwdeg')[0]
+			if wdeg != mrv:
+				print("FAILED test_domwdeg\nExplanation:\nboard %r has %d solutions, dom/wdeg found %d" % (board, mrv, wdeg))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_domwdeg---\n")
+	return score
+
+
+##the support-bitmask propagators prune exactly what the value by value
+##ones prune, so they must make the same decisions
+def test_bits():
+	score = 0
+	print("---starting test_bits---")
+	try:
+		did_fail = False
+		pairs = [(propagators.prop_FC, propagators.prop_FC_bits),
+		         (propagators.prop_GAC, propagators.prop_GAC_bits)]
+		for n, expected in sorted(QUEENS_COUNTS.items()):
+			for prop, bits in pairs:
+				want = count(nQueens(n), prop)
+				got = count(nQueens(n), bits)
+				if want[0] != expected or got != want:
+					print("FAILED test_bits\nExplanation:\n%d-queens solutions, decisions with %s: %r, with %s: %r" % (n, prop.__name__, want, bits.__name__, got))
+					did_fail = True
+		for board in PUZZLES:
+			want = count(futoshiki_csp.futoshiki_csp_model_1(board)[0], propagators.prop_GAC)
+			got = count(futoshiki_csp.futoshiki_csp_model_1(board)[0], propagators.prop_GAC_bits)
+			if got != want:
+				print("FAILED test_bits\nExplanation:\nboard %r solutions, decisions with prop_GAC: %r, with prop_GAC_bits: %r" % (board, want, got))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_bits---\n")
+	return score
+
+
+##the compiled core must find the same solutions as BT, whichever way a
+##constraint is compiled (binary masks, tables, all-different filtering,
+##forward checked predicates)
+def test_compiled():
+	score = 0
+	print("---starting test_compiled---")
+	try:
+		did_fail = False
+		cases = [(nQueens(n), expected) for n, expected in sorted(QUEENS_COUNTS.items())]
+		cases.append((futoshiki_csp.futoshiki_csp_model_3(empty_board(4))[0], 576))
+		for board in PUZZLES:
+			for model in (1, 2, 3):
+				csp = getattr(futoshiki_csp, 'futoshiki_csp_model_%d' % model)(board)[0]
+				cases.append((csp, count(csp, propagators.prop_GAC)[0]))
+		vars = [Variable('S{}'.format(i), range(5)) for i in range(5)]
+		sums = CSP("Sum", vars)
+		sums.add_constraint(PredicateConstraint("Sum", vars, lambda vals: sum(vals) == 10))
+		cases.append((sums, 381))
+		for csp, expected in cases:
+			for table_limit in (10000, 0):
+				solver = csp_compiled.CompiledSolver(csp_compiled.compile_csp(csp, table_limit))
+				got = solver.count()
+				if got != expected:
+					print("FAILED test_compiled\nExplanation:\n%s should have %d solutions, compiled (table_limit %d) found %d" % (csp.name, expected, table_limit, got))
+					did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_compiled---\n")
+	return score
+
+
+class BoundsWatcher(Constraint):
+    '''Constraint that only counts how often the engine propagates it'''
+    events = BOUNDS
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.nCalls = 0
+
+    def check(self, vals):
+        return True
+
+    def propagate(self, delta=None):
+        self.nCalls += 1
+        return True
+
+def unary(name, var, bad):
+    '''table constraint removing value bad from var'''
+    con = Constraint(name, [var])
+    con.add_satisfying_tuples([(val,) for val in var.domain() if val != bad])
+    return con
+
+##the event engine must make the same decisions as prop_GAC, and must only
+##wake a BOUNDS subscriber when a smallest or largest value goes
+def test_events():
+	score = 0
+	print("---starting test_events---")
+	try:
+		did_fail = False
+		for n, expected in sorted(QUEENS_COUNTS.items()):
+			want = count(nQueens(n), propagators.prop_GAC)
+			got = count(nQueens(n), propagators.prop_events)
+			if want[0] != expected or got != want:
+				print("FAILED test_events\nExplanation:\n%d-queens solutions, decisions with prop_GAC: %r, with prop_events: %r" % (n, want, got))
+				did_fail = True
+		for board in PUZZLES:
+			for model in (1, 2, 3):
+				build = getattr(futoshiki_csp, 'futoshiki_csp_model_%d' % model)
+				want = count(build(board)[0], propagators.prop_GAC, 100)
+				got = count(build(board)[0], propagators.prop_events, 100)
+				if got != want:
+					print("FAILED test_events\nExplanation:\nmodel %d solutions, decisions with prop_GAC: %r, with prop_events: %r" % (model, want, got))
+					did_fail = True
+
+		x = Variable('X', [1, 2, 3, 4, 5])
+		y = Variable('Y', [1, 2, 3, 4, 5])
+		watcher = BoundsWatcher("W", [x, y])
+		simpleCSP = CSP("Events", [x, y])
+		simpleCSP.add_constraint(unary("X!=3", x, 3))
+		simpleCSP.add_constraint(watcher)
+		propagators.prop_events(simpleCSP)
+		if not did_fail and (x.cur_domain() != [1, 2, 4, 5] or watcher.nCalls != 1):
+			print("FAILED test_events\nExplanation:\nremoving 3 from 1..5 should not wake a BOUNDS constraint (propagated %d times)" % watcher.nCalls)
+			did_fail = True
+		simpleCSP.add_constraint(unary("X!=5", x, 5))
+		watcher.nCalls = 0
+		propagators.prop_events(simpleCSP)
+		if not did_fail and (x.cur_domain() != [1, 2, 4] or watcher.nCalls != 2):
+			print("FAILED test_events\nExplanation:\nremoving the largest value should wake the BOUNDS constraint (propagated %d times, expected 2)" % watcher.nCalls)
+			did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_events---\n")
+	return score
+
+
+def not_equal(name, x, y):
+    '''binary table constraint x != y'''
+    con = Constraint(name, [x, y])
+    con.add_satisfying_tuples([t for t in itertools.product(x.domain(), y.domain()) if t[0] != t[1]])
+    return con
+
+##SAC removes values GAC keeps (Z = 1 or 2 leaves X and Y one value
+##for both) without losing solutions, also when stopped by its time limit
+def test_sac():
+	score = 0
+	print("---starting test_sac---")
+	try:
+		did_fail = False
+		x = Variable('X', [1, 2])
+		y = Variable('Y', [1, 2])
+		z = Variable('Z', [1, 2, 3])
+		simpleCSP = CSP("SAC", [x, y, z])
+		simpleCSP.add_constraint(not_equal("X!=Y", x, y))
+		simpleCSP.add_constraint(not_equal("X!=Z", x, z))
+		simpleCSP.add_constraint(not_equal("Y!=Z", y, z))
+		solver = BT(simpleCSP, sac=True)
+		got = solver.bt_count(propagators.prop_GAC)
+		if got != 2 or solver.nSACPrunings != 2:
+			print("FAILED test_sac\nExplanation:\nSAC should remove Z = 1 and Z = 2 and leave 2 solutions, removed %d values and found %d" % (solver.nSACPrunings, got))
+			did_fail = True
+		for n, expected in sorted(QUEENS_COUNTS.items()):
+			for limit in (None, 0):
+				got = count(nQueens(n), propagators.prop_GAC, sac=True, sac_time_limit=limit)[0]
+				if got != expected:
+					print("FAILED test_sac\nExplanation:\n%d-queens with SAC (time limit %r) should have %d solutions, found %d" % (n, limit, expected, got))
+					did_fail = True
+		for board in PUZZLES:
+			want = count(futoshiki_csp.futoshiki_csp_model_3(board)[0], propagators.prop_GAC)[0]
+			got = count(futoshiki_csp.futoshiki_csp_model_3(board)[0], propagators.prop_GAC, sac=True)[0]
+			if got != want:
+				print("FAILED test_sac\nExplanation:\nboard %r has %d solutions, found %d with SAC" % (board, want, got))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_sac---\n")
+	return score
+
+
+##the two sweeps of an inequality chain leave exactly the supported values
+##(also for domains not in increasing order), and futoshiki models built
+##with chains make the same decisions as with ordered-pair tables
+def test_inequality_chains():
+	score = 0
+	print("---starting test_inequality_chains---")
+	old = futoshiki_csp.BOUNDS_INEQUALITIES
+	try:
+		did_fail = False
+		vars = [Variable(name, [1, 2, 3, 4, 5]) for name in 'ABCD']
+		simpleCSP = CSP("Chain", vars)
+		simpleCSP.add_constraint(InequalityConstraint("A<B<C<D", vars, '<<<'))
+		propagators.prop_GAC(simpleCSP)
+		answer = [[1, 2], [2, 3], [3, 4], [4, 5]]
+		var_vals = [x.cur_domain() for x in vars]
+		if var_vals != answer:
+			print("FAILED test_inequality_chains\nExplanation:\nGAC variable domains should be: %r\nGAC variable domains are: %r" % (answer, var_vals))
+			did_fail = True
+
+		a = Variable('A', [3, 1, 2])
+		b = Variable('B', [2, 3, 1])
+		c = Variable('C', [1, 3, 2])
+		for ops, expected in (('<<', 1), ('<>', 5), ('><', 5), ('>>', 1)):
+			simpleCSP = CSP("Unsorted", [a, b, c])
+			simpleCSP.add_constraint(InequalityConstraint(ops, [a, b, c], ops))
+			for prop in (propagators.prop_BT, propagators.prop_GAC, propagators.prop_events):
+				got = count(simpleCSP, prop)[0]
+				if got != expected:
+					print("FAILED test_inequality_chains\nExplanation:\nchain %s should have %d solutions, %s found %d" % (ops, expected, prop.__name__, got))
+					did_fail = True
+
+		for board in PUZZLES:
+			for model in (1, 3):
+				build = getattr(futoshiki_csp, 'futoshiki_csp_model_%d' % model)
+				for prop in (propagators.prop_GAC, propagators.prop_events):
+					futoshiki_csp.BOUNDS_INEQUALITIES = False
+					want = count(build(board)[0], prop, 100)
+					futoshiki_csp.BOUNDS_INEQUALITIES = True
+					csp = build(board)[0]
+					got = count(csp, prop, 100)
+					if got != want:
+						print("FAILED test_inequality_chains\nExplanation:\nmodel %d solutions, decisions with tables: %r, with chains: %r" % (model, want, got))
+						did_fail = True
+				compiled = csp_compiled.CompiledSolver(csp_compiled.compile_csp(csp)).count(100)
+				if compiled != want[0]:
+					print("FAILED test_inequality_chains\nExplanation:\nmodel %d with chains compiled finds %d solutions, expected %d" % (model, compiled, want[0]))
+					did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+	finally:
+		futoshiki_csp.BOUNDS_INEQUALITIES = old
+
+	print("---finished test_inequality_chains---\n")
+	return score
+
+##closing a bt_solutions generator early must leave every variable
+##unassigned with its whole domain, and bt_count must stop at limit
+def test_solution_generator():
+	score = 0
+	print("---starting test_solution_generator---")
+	try:
+		did_fail = False
+		for prop in (propagators.prop_BT, propagators.prop_FC, propagators.prop_GAC):
+			csp = nQueens(6)
+			solutions = BT(csp).bt_solutions(prop)
+			soln = next(solutions)
+			if not all(queensCheck(i, j, soln[csp.vars[i]], soln[csp.vars[j]])
+					   for i, j in itertools.combinations(range(6), 2)):
+				print("FAILED test_solution_generator\nExplanation:\n%s yields a wrong solution: %r" % (prop.__name__, [soln[v] for v in csp.vars]))
+				did_fail = True
+			solutions.close()
+			for var in csp.vars:
+				if var.is_assigned() or var.cur_domain() != var.domain():
+					print("FAILED test_solution_generator\nExplanation:\nafter closing the %s generator %s is assigned %r with current domain %r" % (prop.__name__, var.name, var.get_assigned_value(), var.cur_domain()))
+					did_fail = True
+					break
+			for limit in (0, 1, 5, 40, 100):
+				solver = BT(nQueens(7))
+				got = solver.bt_count(prop, limit)
+				want = min(limit, QUEENS_COUNTS[7])
+				if got != want or solver.nSolutions != want:
+					print("FAILED test_solution_generator\nExplanation:\n%s bt_count(limit=%d) on 7-queens should give %d, gives %d" % (prop.__name__, limit, want, got))
+					did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_solution_generator---\n")
+	return score
+
+##portfolio_solve: the winner's solution must satisfy every constraint,
+##and a configuration that raises is reported in 'errors'
+def test_portfolio():
+	score = 0
+	print("---starting test_portfolio---")
+	try:
+		did_fail = False
+		configs = [('broken', propagators.prop_FC, {'no_such_option': True}),
+				   ('FC', propagators.prop_FC, {}),
+				   ('GAC', propagators.prop_GAC, {})]
+		for processes in (1, 3):
+			csp = nQueens(8)
+			result = csp_parallel.portfolio_solve(csp, configs, timeout=60, processes=processes)
+			soln = result['solution']
+			if result['config'] not in ('FC', 'GAC') or not result['solved'] or soln is None:
+				print("FAILED test_portfolio\nExplanation:\nwith %d processes 8-queens should be solved by FC or GAC, result: %r" % (processes, result))
+				did_fail = True
+				continue
+			bad = [c.name for c in csp.get_all_cons() if not c.check([soln[v] for v in c.get_scope()])]
+			if bad or any(soln[v] != v.get_assigned_value() for v in csp.vars):
+				print("FAILED test_portfolio\nExplanation:\nwinner %s's solution violates %r or is not assigned" % (result['config'], bad))
+				did_fail = True
+			if processes == 1 and 'broken' not in result['errors']:
+				print("FAILED test_portfolio\nExplanation:\nthe raising configuration should be in errors: %r" % result['errors'])
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_portfolio---\n")
+	return score
+
+def crashing_queens(qi, qj, vals):
+	'''queensCheck that raises in a worker process when queen 1 is in
+	   column 1'''
+	if qi == 0 and vals[0] == 1 and multiprocessing.parent_process() is not None:
+		raise ValueError("injected failure")
+	return queensCheck(qi, qj, vals[0], vals[1])
+
+##parallel_search must find the same solutions, decisions and prunings as
+##the sequential search, and report a worker that fails instead of hanging
+def test_parallel_search():
+	score = 0
+	print("---starting test_parallel_search---")
+	try:
+		did_fail = False
+		for prop in (propagators.prop_FC, propagators.prop_GAC):
+			solver = BT(nQueens(8))
+			want = (solver.bt_count(prop), solver.nDecisions, solver.nPrunings)
+			for workers in (1, 2):
+				csp = nQueens(8)
+				result = csp_parallel.parallel_search(csp, prop, workers=workers, mode='all', timeout=60)
+				got = (result['nSolutions'], result['nDecisions'], result['nPrunings'])
+				if got != want or result['errors']:
+					print("FAILED test_parallel_search\nExplanation:\n8-queens with %s on %d workers: solutions, decisions, prunings should be %r, got %r (errors %r)" % (prop.__name__, workers, want, got, result['errors']))
+					did_fail = True
+				result = csp_parallel.parallel_search(csp, prop, workers=workers, mode='first', timeout=60)
+				soln = result['solution']
+				if not result['solved'] or soln is None or not all(c.check([soln[v] for v in c.get_scope()]) for c in csp.get_all_cons()):
+					print("FAILED test_parallel_search\nExplanation:\nfirst 8-queens solution with %s on %d workers is wrong: %r" % (prop.__name__, workers, result))
+					did_fail = True
+
+		dom = list(range(1, 9))
+		vars = [Variable('Q{}'.format(i), dom) for i in dom]
+		csp = CSP("Crashing-8-Queens", vars)
+		for qi, qj in itertools.combinations(range(8), 2):
+			csp.add_constraint(PredicateConstraint("C(Q{},Q{})".format(qi+1, qj+1), [vars[qi], vars[qj]],
+												   functools.partial(crashing_queens, qi, qj)))
+		for mode in ('all', 'first'):
+			for workers in (1, 2):
+				result = csp_parallel.parallel_search(csp, propagators.prop_FC, workers=workers, mode=mode, timeout=60)
+				if result['timed_out'] or not result['errors'] or (result['solved'] is not None and mode == 'all'):
+					print("FAILED test_parallel_search\nExplanation:\na failing worker (mode %s, %d workers) should be reported, got %r" % (mode, workers, result))
+					did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_parallel_search---\n")
+	return score
+
+##batch_solve: one record per non blank line, an error record for a bad
+##line, in input order with and without worker processes
+def test_batch_solve():
+	score = 0
+	print("---starting test_batch_solve---")
+	try:
+		did_fail = False
+		unsolvable = [[1,'.',1,'.',0],[0,'.',0,'.',0],[0,'.',0,'.',0]]
+		lines = [json.dumps({'id': 'puzzle1', 'board': PUZZLES[0]}),
+				 json.dumps({'id': 'unsolvable', 'board': unsolvable}),
+				 '',
+				 json.dumps(PUZZLES[1]),
+				 '[[1, ".", 2], oops']
+		want = [(0, 'puzzle1', True), (1, 'unsolvable', False), (2, None, True), (3, None, 'error')]
+		for workers, order in ((0, 'input'), (2, 'input'), (2, 'completion')):
+			out = io.StringIO()
+			n = futoshiki_batch.batch_solve(io.StringIO('\n'.join(lines) + '\n'), out,
+											model=3, workers=workers, order=order)
+			records = [json.loads(line) for line in out.getvalue().splitlines()]
+			got = [(r['index'], r.get('id'), 'error' if 'error' in r else r['solved']) for r in records]
+			if order == 'completion':
+				got.sort(key=lambda r: r[0])
+			if n != 4 or got != want:
+				print("FAILED test_batch_solve\nExplanation:\nworkers=%d order=%s should give (index, id, solved) %r, gives %r" % (workers, order, want, got))
+				did_fail = True
+				continue
+			records.sort(key=lambda r: r['index'])
+			if records[0]['solution'] != [[3,2,1,4],[1,3,4,2],[4,1,2,3],[2,4,3,1]] or records[1]['solution'] is not None:
+				print("FAILED test_batch_solve\nExplanation:\nworkers=%d wrong solutions: %r" % (workers, records[:2]))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_batch_solve---\n")
+	return score
+
+##restarts in parallel_search must not revisit the values a worker gave
+##away: 10-queens with the first queen in column 1 has 64 solutions
+def test_parallel_restarts():
+	score = 0
+	print("---starting test_parallel_restarts---")
+	try:
+		did_fail = False
+		csp = nQueens(10)
+		pin = Constraint("Q1=1", [csp.vars[0]])
+		pin.add_satisfying_tuples([(1,)])
+		csp.add_constraint(pin)
+		for schedule in ('luby', 'geometric'):
+			for workers in (2, 3, 4):
+				for split_tasks in (1, 2):
+					result = csp_parallel.parallel_search(csp, propagators.prop_FC, workers=workers, mode='all', split_tasks=split_tasks,
+														  timeout=60, bt_options={'restarts': schedule, 'restart_base': 1})
+					if result['nSolutions'] != 64:
+						print("FAILED test_parallel_restarts\nExplanation:\n%s restarts on %d workers (%d split tasks, %d steals) count %r solutions, should be 64" % (schedule, workers, split_tasks, result['nSteals'], result['nSolutions']))
+						did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_parallel_restarts---\n")
+	return score
+
+def stored_header(path):
+	'''(data start, header) of a csp_store file'''
+	with open(path, 'rb') as f:
+		magic, version, hlen = csp_store._PREFIX.unpack(f.read(csp_store._PREFIX.size))
+		header = json.loads(f.read(hlen).decode('utf-8'))
+	return csp_store._align(csp_store._PREFIX.size + hlen), header
+
+##csp_store: a saved and loaded model must have the same solutions, the
+##cache must miss when the model options or versions change, and a
+##truncated or corrupt file must be rejected
+def test_csp_store():
+	score = 0
+	print("---starting test_csp_store---")
+	old = (futoshiki_csp.BOUNDS_INEQUALITIES, futoshiki_csp.MODEL_VERSION)
+	tmp = tempfile.mkdtemp()
+	try:
+		did_fail = False
+		for board in PUZZLES:
+			for model in (1, 2, 3):
+				build = getattr(futoshiki_csp, 'futoshiki_csp_model_%d' % model)
+				csp, var_arr = build(board)
+				path = os.path.join(tmp, 'model%d.csp' % model)
+				csp_store.save_csp(csp, path, var_arr)
+				loaded, layout = csp_store.load_csp(path)
+				want = count(csp, propagators.prop_GAC, 100)
+				got = count(loaded, propagators.prop_GAC, 100)
+				names = [[v.name for v in row] for row in layout]
+				if got != want or names != [[v.name for v in row] for row in var_arr]:
+					print("FAILED test_csp_store\nExplanation:\nmodel %d solutions, decisions: %r, after save and load: %r" % (model, want, got))
+					did_fail = True
+
+		board = PUZZLES[1]
+		build = futoshiki_csp.futoshiki_csp_model_3
+		paths = set()
+		for bounds, version in ((False, old[1]), (True, old[1]), (False, old[1] + 1)):
+			futoshiki_csp.BOUNDS_INEQUALITIES = bounds
+			futoshiki_csp.MODEL_VERSION = version
+			paths.add(csp_store.cache_path(build, board, tmp))
+			csp, var_arr = csp_store.cached_model(build, board, tmp)
+			chains = any(isinstance(c, InequalityConstraint) for c in csp.get_all_cons())
+			if chains != bounds:
+				print("FAILED test_csp_store\nExplanation:\nwith BOUNDS_INEQUALITIES %r and MODEL_VERSION %d the cache returns a model %s inequality chains" % (bounds, version, "with" if chains else "without"))
+				did_fail = True
+		futoshiki_csp.BOUNDS_INEQUALITIES, futoshiki_csp.MODEL_VERSION = old
+		if len(paths) != 3:
+			print("FAILED test_csp_store\nExplanation:\nchanging the model options or version should change the cache file: %r" % sorted(paths))
+			did_fail = True
+
+		path = os.path.join(tmp, 'model2.csp')
+		with open(path, 'rb') as f:
+			data = f.read()
+		start, header = stored_header(path)
+		table = start + header['tables'][-1][3]
+		damaged = {'truncated': data[:table + 1],
+				   'header cut': data[:csp_store._PREFIX.size + 10],
+				   'empty': b'',
+				   'bad table': data[:table] + bytes([data[table] ^ 1]) + data[table + 1:]}
+		for what, content in damaged.items():
+			with open(path, 'wb') as f:
+				f.write(content)
+			try:
+				csp, layout = csp_store.load_csp(path)
+				for c in csp.get_all_cons():
+					c.sat_tuples
+			except ValueError:
+				continue
+			print("FAILED test_csp_store\nExplanation:\nloading a %s file should raise ValueError" % what)
+			did_fail = True
+
+		path = csp_store.cache_path(build, board, tmp)
+		with open(path, 'r+b') as f:
+			f.truncate(os.path.getsize(path) // 2)
+		csp, var_arr = csp_store.cached_model(build, board, tmp)
+		if count(csp, propagators.prop_GAC, 100)[0] != 100:
+			print("FAILED test_csp_store\nExplanation:\na damaged cache file should be built again")
+			did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+	finally:
+		futoshiki_csp.BOUNDS_INEQUALITIES, futoshiki_csp.MODEL_VERSION = old
+		shutil.rmtree(tmp)
+
+	print("---finished test_csp_store---\n")
+	return score
+
+##shared relations: the futoshiki models must have the same solutions
+##with and without SHARE_RELATIONS, and a relation used with reordered
+##positions must constrain the reordered scope
+def test_shared_relations():
+	score = 0
+	print("---starting test_shared_relations---")
+	old = futoshiki_csp.SHARE_RELATIONS
+	try:
+		did_fail = False
+		for board in PUZZLES:
+			for model in (1, 2, 3):
+				build = getattr(futoshiki_csp, 'futoshiki_csp_model_%d' % model)
+				futoshiki_csp.SHARE_RELATIONS = False
+				want = count(build(board)[0], propagators.prop_GAC, 100)
+				futoshiki_csp.SHARE_RELATIONS = True
+				got = count(build(board)[0], propagators.prop_GAC, 100)
+				if got != want:
+					print("FAILED test_shared_relations\nExplanation:\nmodel %d solutions, decisions with copied tables: %r, with shared relations: %r" % (model, want, got))
+					did_fail = True
+		futoshiki_csp.SHARE_RELATIONS = old
+
+		less = Relation([t for t in itertools.product(range(1, 5), repeat=2) if t[0] < t[1]], '<')
+		x, y, z = [Variable(name, [1, 2, 3, 4]) for name in 'XYZ']
+		greater = Constraint("X>Y", [x, y])
+		greater.set_relation(less, (1, 0))
+		smaller = Constraint("Y<Z", [y, z])
+		smaller.set_relation(less)
+		if not greater.check([3, 1]) or greater.check([1, 3]) or not smaller.check([1, 3]):
+			print("FAILED test_shared_relations\nExplanation:\nX>Y through '<' with positions (1, 0) checks (3, 1) as %r and (1, 3) as %r" % (greater.check([3, 1]), greater.check([1, 3])))
+			did_fail = True
+		simpleCSP = CSP("Reversed", [x, y, z])
+		simpleCSP.add_constraint(greater)
+		simpleCSP.add_constraint(smaller)
+		propagators.prop_GAC(simpleCSP)
+		answer = [[2, 3, 4], [1, 2, 3], [2, 3, 4]]
+		var_vals = [v.cur_domain() for v in (x, y, z)]
+		if var_vals != answer:
+			print("FAILED test_shared_relations\nExplanation:\nGAC variable domains should be: %r\nGAC variable domains are: %r" % (answer, var_vals))
+			did_fail = True
+		for prop in (propagators.prop_BT, propagators.prop_FC, propagators.prop_GAC, propagators.prop_CT):
+			got = count(simpleCSP, prop)[0]
+			if got != 14:
+				print("FAILED test_shared_relations\nExplanation:\nX>Y<Z should have 14 solutions, %s finds %d" % (prop.__name__, got))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+	finally:
+		futoshiki_csp.SHARE_RELATIONS = old
+
+	print("---finished test_shared_relations---\n")
+	return score
+
+##write_table/MappedTable: hash and column index lookups must agree with
+##the tuples written, and GAC on MappedTableConstraints must count the
+##same solutions with the same decisions as on in-memory tables
+def test_mapped_table():
+	score = 0
+	print("---starting test_mapped_table---")
+	tmp = tempfile.mkdtemp()
+	try:
+		did_fail = False
+		rng = random.Random(3)
+		tuples = [tuple(rng.randrange(6) for k in range(3)) for i in range(150)]
+		tuples += tuples[:10]       #duplicates are kept
+		path = os.path.join(tmp, 'random')
+		csp_store.write_table(path, tuples, values=range(7))
+		table = csp_store.MappedTable(path)
+		if len(table) != len(tuples):
+			print("FAILED test_mapped_table\nExplanation:\n%d tuples written, table has %d" % (len(tuples), len(table)))
+			did_fail = True
+		for t in itertools.product(range(8), repeat=3):
+			codes = tuple(table.code.get(val, -1) for val in t)
+			if table.contains_codes(codes) != (t in tuples):
+				print("FAILED test_mapped_table\nExplanation:\ncontains_codes of %r should be %r" % (t, t in tuples))
+				did_fail = True
+				break
+		for pos in range(3):
+			for val in range(7):
+				rows = sorted(table.rows_with(pos, table.code[val]))
+				want = [r for r, t in enumerate(tuples) if t[pos] == val]
+				if rows != want or any(table.row(r)[pos] != table.code[val] for r in rows):
+					print("FAILED test_mapped_table\nExplanation:\nrows_with(%d, code of %d) should be %r, is %r" % (pos, val, want, rows))
+					did_fail = True
+
+		vars = [Variable('V{}'.format(i), list(range(7))) for i in range(5)]
+		scopes = [(0, 1, 2), (1, 2, 3), (2, 3, 4), (4, 0, 1)]
+		results = []
+		for mapped in (False, True):
+			csp = CSP("Random", vars)
+			for s in scopes:
+				scope = [vars[i] for i in s]
+				if mapped:
+					c = csp_store.MappedTableConstraint("M{}".format(s), scope, table)
+				else:
+					c = Constraint("C{}".format(s), scope)
+					c.add_satisfying_tuples(tuples)
+				csp.add_constraint(c)
+			results.append(count(csp, propagators.prop_GAC))
+			if mapped:
+				results.append(count(csp, propagators.prop_FC))
+		queens = nQueens(7)
+		mapped_queens = CSP("Mapped-7-Queens", queens.vars)
+		for c in queens.get_all_cons():
+			x, y = c.get_scope()
+			path = os.path.join(tmp, c.name)
+			csp_store.write_table(path, c.sat_tuples)
+			mapped_queens.add_constraint(csp_store.MappedTableConstraint(c.name, [x, y], csp_store.MappedTable(path)))
+		want = [results[0], results[0], (QUEENS_COUNTS[7], count(queens, propagators.prop_GAC)[1])]
+		got = [results[1], (results[2][0], results[1][1]), count(mapped_queens, propagators.prop_GAC)]
+		if got != want:
+			print("FAILED test_mapped_table\nExplanation:\n(solutions, decisions) with in-memory tables: %r, with mapped tables: %r" % (want, got))
+			did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+	finally:
+		shutil.rmtree(tmp)
+
+	print("---finished test_mapped_table---\n")
+	return score
+
+##add_satisfying_tuples from a generator, in several chunks and indexed
+##lazily, must give the same constraint as the same tuples in a list
+def test_streamed_tuples():
+	score = 0
+	print("---starting test_streamed_tuples---")
+	try:
+		did_fail = False
+		vars = [Variable('V{}'.format(i), list(range(7))) for i in range(7)]
+		streamed = Constraint("Streamed", vars)
+		listed = Constraint("Listed", vars)
+		streamed.add_satisfying_tuples(itertools.permutations(range(7)))
+		listed.add_satisfying_tuples(list(itertools.permutations(range(7))))
+		if list(streamed.sat_tuples) != list(listed.sat_tuples) or streamed.nIndexed != 0:
+			print("FAILED test_streamed_tuples\nExplanation:\n%d permutations streamed in chunks of %d give %d tuples (%d indexed), as a list %d" % (5040, Constraint.chunk_size, len(streamed.sat_tuples), streamed.nIndexed, len(listed.sat_tuples)))
+			did_fail = True
+
+		def supports():
+			return [(s.has_support(var, val), s.nIndexed) for s in (streamed, listed) for var in vars for val in range(7)]
+
+		for var in vars[:5]:
+			var.prune_value(5)
+			var.prune_value(6)
+		first = supports()
+		for var in vars:
+			var.restore_curdom()
+		streamed.add_satisfying_tuples((val,) * 7 for val in range(7))
+		listed.add_satisfying_tuples([(val,) * 7 for val in range(7)])
+		for var in vars:
+			for val in range(1, 7):
+				if var.in_cur_domain(val):
+					var.prune_value(val)
+		second = supports()
+		for var in vars:
+			var.restore_curdom()
+		for name, got in (("before", first), ("after", second)):
+			half = len(got) // 2
+			if got[:half] != got[half:] or all(s for s, n in got):
+				print("FAILED test_streamed_tuples\nExplanation:\nhas_support %s adding tuples: streamed %r, listed %r" % (name, got[:half], got[half:]))
+				did_fail = True
+		if [s for s, n in second].count(True) != 2 * 7 or second[0][1] != 5047:
+			print("FAILED test_streamed_tuples\nExplanation:\nonly (v, 0) should be supported once (0,...,0) is added: %r" % second)
+			did_fail = True
+
+		queens = nQueens(6)
+		streamed_queens = CSP("Streamed-6-Queens", queens.vars)
+		for c in queens.get_all_cons():
+			s = Constraint(c.name, c.get_scope())
+			s.chunk_size = 3
+			s.add_satisfying_tuples(t for t in c.sat_tuples)
+			streamed_queens.add_constraint(s)
+		for prop in (propagators.prop_FC, propagators.prop_GAC):
+			want = count(queens, prop)
+			got = count(streamed_queens, prop)
+			if got != want:
+				print("FAILED test_streamed_tuples\nExplanation:\n6-queens solutions, decisions with %s: tuples from lists %r, streamed in chunks of 3 %r" % (prop.__name__, want, got))
+				did_fail = True
+		if not did_fail:
+			print("PASS")
+			score = 1
+	except Exception:
+		print("Error occurred: %r" % traceback.print_exc())
+
+	print("---finished test_streamed_tuples---\n")
+	return score
+
+
+def main():
+	TOTAL_POINTS = 18
+	total_score = 0
+
+	total_score += test_compact_table()
+	total_score += test_alldiff()
+	total_score += test_restarts()
+	total_score += test_domwdeg()
+	total_score += test_bits()
+	total_score += test_compiled()
+	total_score += test_events()
+	total_score += test_sac()
+	total_score += test_inequality_chains()
+	total_score += test_solution_generator()
+	total_score += test_portfolio()
+	total_score += test_parallel_search()
+	total_score += test_batch_solve()
+	total_score += test_parallel_restarts()
+	total_score += test_csp_store()
+	total_score += test_shared_relations()
+	total_score += test_mapped_table()
+	total_score += test_streamed_tuples()
+
+	if total_score == TOTAL_POINTS:
+		print("Score: %d/%d; Passed all tests" % (total_score,TOTAL_POINTS))
+	else:
+		print("Score: %d/%d; Did not pass all tests." % (total_score,TOTAL_POINTS))
+
+
+if __name__=="__main__":
+	main()